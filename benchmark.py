@@ -0,0 +1,433 @@
+"""Offline benchmark for the extract/split pipeline.
+
+Synthetic fixture videos are generated with ffmpeg's lavfi sources and served
+from a local HTTP server as a page with a schema.org VideoObject, which
+yt-dlp's generic extractor reads, chapters included. Every stage runs in a
+fresh process in its own scratch directory, so wall time, CPU time, peak RSS
+and disk usage are those of that stage alone.
+
+    python benchmark.py --durations 60,600 --chapters 4,16 --output bench.json
+    python benchmark.py --compare bench.json --output bench-new.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import subprocess
+import threading
+import multiprocessing
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+STAGES = ["startup", "metadata", "download", "split", "extract", "lazy"]
+JOB_TIMEOUT = 3600
+
+
+def write_chapter_metadata(path: str, chapters: List[Dict]) -> None:
+    with open(path, "w") as f:
+        f.write(";FFMETADATA1\n")
+        for chapter in chapters:
+            f.write("[CHAPTER]\nTIMEBASE=1/1000\n")
+            f.write(f"START={int(chapter['start_time'] * 1000)}\nEND={int(chapter['end_time'] * 1000)}\n")
+            f.write(f"title={chapter['title']}\n")
+
+
+def plan_chapters(duration: float, count: int, seed: int = 0) -> List[Dict]:
+    # Uneven lengths, like real chapters; seeded so every run of a
+    # configuration cuts at the same points.
+    rng = random.Random(seed)
+    weights = [rng.uniform(0.5, 1.5) for _ in range(count)]
+    total = sum(weights)
+    chapters, start = [], 0.0
+    for i, weight in enumerate(weights, 1):
+        end = duration if i == count else round(start + duration * weight / total, 3)
+        chapters.append({"title": f"Chapter {i}", "start_time": start, "end_time": end})
+        start = end
+    return chapters
+
+
+def make_fixture(fixture_dir: str, config: Dict) -> Dict:
+    name = "{duration}s-{chapters}ch-{video_codec}-{audio_codec}-{resolution}".format(**config)
+    path = os.path.join(fixture_dir, f"{name}.mp4")
+    chapters = plan_chapters(config["duration"], config["chapters"])
+    if not os.path.exists(path):
+        print(f"Generating fixture {name}...")
+        metadata_path = os.path.join(fixture_dir, f"{name}.ffmetadata")
+        write_chapter_metadata(metadata_path, chapters)
+        tmp_path = os.path.join(fixture_dir, f"{name}.tmp.mp4")
+        subprocess.run([
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "lavfi", "-i", f"testsrc2=size={config['resolution']}:rate={config['fps']}:duration={config['duration']}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={config['duration']}",
+            "-i", metadata_path, "-map", "0:v", "-map", "1:a", "-map_chapters", "2",
+            "-c:v", config["video_codec"], "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-g", str(config["fps"] * config["gop_seconds"]),
+            "-c:a", config["audio_codec"], "-b:a", "128k",
+            "-movflags", "+faststart", "-shortest", tmp_path,
+        ], check=True)
+        os.replace(tmp_path, path)
+
+    video_object = {
+        "@context": "https://schema.org",
+        "@type": "VideoObject",
+        "name": name,
+        "contentUrl": f"{name}.mp4",
+        "encodingFormat": "video/mp4",
+        "duration": f"PT{config['duration']}S",
+        "hasPart": [
+            {"@type": "Clip", "name": chapter["title"],
+             "startOffset": chapter["start_time"], "endOffset": chapter["end_time"]}
+            for chapter in chapters
+        ],
+    }
+    with open(os.path.join(fixture_dir, f"{name}.jsonld"), "w") as f:
+        json.dump(video_object, f)
+    return {"name": name, "path": os.path.abspath(path), "page": f"{name}.html", "chapters": chapters}
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    """Fixture pages plus static files with single-range support, as
+    yt-dlp's chunked downloads expect."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_page(self):
+        # The generic extractor only follows absolute content URLs, and the
+        # server's port is only known per run.
+        name = os.path.basename(self.path.split("?")[0])[:-len(".html")]
+        path = os.path.join(self.directory, f"{name}.jsonld")
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path) as f:
+            video_object = json.load(f)
+        video_object["contentUrl"] = f"http://{self.headers['Host']}/{video_object['contentUrl']}"
+        body = (f"<html><head><title>{name}</title>"
+                f'<script type="application/ld+json">{json.dumps(video_object)}</script>'
+                f"</head><body></body></html>").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def send_head(self):
+        if self.path.split("?")[0].endswith(".html"):
+            return self.send_page()
+        header = self.headers.get("Range", "")
+        path = self.translate_path(self.path)
+        if not header.startswith("bytes=") or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        first, _, last = header[len("bytes="):].partition("-")
+        start = int(first) if first else max(size - int(last), 0)
+        end = min(int(last), size - 1) if first and last else size - 1
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "_remaining", None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+
+def serve_fixtures(fixture_dir: str) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(FixtureRequestHandler, directory=fixture_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def disk_bytes(path: str) -> int:
+    # Store objects are hardlinked into job directories; count each once.
+    seen, total = set(), 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def wait_for_job(client, job_id: str) -> Dict:
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while True:
+        state = client.get(f"/api/jobs/{job_id}").json()
+        if state["status"] in ("completed", "failed") or time.monotonic() > deadline:
+            return state
+        time.sleep(0.05)
+
+
+def run_stage(stage: str, url: str, fixture: Dict, options: Dict) -> Dict:
+    # Runs inside the stage process, with the scratch directory as cwd.
+    if stage == "startup":
+        # Import and app startup up to the first answered health check, as a
+        # freshly booted worker would see it.
+        start = time.perf_counter()
+        import worker
+        imported = time.perf_counter()
+        from fastapi.testclient import TestClient
+        with TestClient(worker.app) as client:
+            if client.get("/api/health").status_code != 200:
+                raise RuntimeError("Health check failed")
+            ready = time.perf_counter()
+        return {"import_s": round(imported - start, 4), "ready_s": round(ready - start, 4)}
+    if stage == "metadata":
+        import worker
+        info = worker.get_video_info(url)
+        if not info or not info.get("chapters"):
+            raise RuntimeError("No chapters extracted")
+        return {"chapters": len(info["chapters"])}
+    if stage == "download":
+        import worker
+        path = worker.download_video(url, "download", options["audio_only"])
+        if not path:
+            raise RuntimeError("Download failed")
+        return {}
+    if stage == "split":
+        from splitter import split_video_by_chapters
+        chapters = [{**chapter, "index": i} for i, chapter in enumerate(fixture["chapters"], 1)]
+        os.makedirs("split", exist_ok=True)
+        files = split_video_by_chapters(fixture["path"], chapters, "split",
+                                        options["accurate"], options["audio_only"])
+        return {"chapters": len(files)}
+    if stage == "extract":
+        import worker
+        from fastapi.testclient import TestClient
+        with TestClient(worker.app) as client:
+            job = client.post("/api/extract", json={
+                "url": url, "accurate_cuts": options["accurate"],
+                "output": "audio" if options["audio_only"] else "both",
+            }).json()
+            state = wait_for_job(client, job["job_id"])
+        if state["status"] != "completed":
+            raise RuntimeError(f"Job {state['status']}: {state.get('error')}")
+        return {"chapters": len(state["result"]["chapters"])}
+    if stage == "lazy":
+        # Extraction with lazy renders, then every chapter file downloaded,
+        # so each one is rendered on demand. With --accurate this covers
+        # chapters re-encoded on their own, without an audio output.
+        import worker
+        from fastapi.testclient import TestClient
+        with TestClient(worker.app) as client:
+            job = client.post("/api/extract", json={
+                "url": url, "accurate_cuts": options["accurate"], "render": "lazy",
+                "output": "audio" if options["audio_only"] else "both",
+            }).json()
+            state = wait_for_job(client, job["job_id"])
+            if state["status"] != "completed":
+                raise RuntimeError(f"Job {state['status']}: {state.get('error')}")
+            files = 0
+            for chapter in state["result"]["chapters"]:
+                for name in ("mp4_download_url", "audio_download_url"):
+                    if chapter.get(name):
+                        response = client.get(chapter[name])
+                        if response.status_code != 200:
+                            raise RuntimeError(f"{chapter[name]}: {response.status_code} {response.text[:200]}")
+                        files += 1
+        return {"chapters": len(state["result"]["chapters"]), "files": files}
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def _stage_process(stage: str, workdir: str, url: str, fixture: Dict, options: Dict, conn) -> None:
+    os.chdir(workdir)
+    # Fresh caches and store per run, so every stage does its full work.
+    os.environ["METADATA_CACHE_PATH"] = os.path.join(workdir, "metadata.sqlite")
+    os.environ["STORE_ROOT"] = os.path.join(workdir, "store")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(workdir, "metrics")
+    sys.path.insert(0, options["repo"])
+    # Imports are done up front so only the stage itself is timed; startup
+    # times them, so only the test client's HTTP library is preloaded.
+    if stage == "startup":
+        import httpx  # noqa: F401
+    else:
+        import splitter  # noqa: F401
+    if stage in ("metadata", "download", "extract", "lazy"):
+        import worker  # noqa: F401
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    error, details = None, {}
+    try:
+        details = run_stage(stage, url, fixture, options)
+    except Exception as e:
+        error = str(e)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send({
+        "wall_s": round(wall, 4),
+        "cpu_user_s": round(after.ru_utime - before.ru_utime + children.ru_utime, 4),
+        "cpu_sys_s": round(after.ru_stime - before.ru_stime + children.ru_stime, 4),
+        # Peaks for the Python process and its largest child (ffmpeg).
+        "peak_rss_kb": after.ru_maxrss,
+        "children_peak_rss_kb": children.ru_maxrss,
+        "error": error,
+        **details,
+    })
+    conn.close()
+
+
+def measure(stage: str, url: str, fixture: Dict, options: Dict) -> Dict:
+    workdir = os.path.abspath(os.path.join(options["workdir"], f"{stage}-{os.urandom(4).hex()}"))
+    os.makedirs(workdir)
+    ctx = multiprocessing.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_stage_process, args=(stage, workdir, url, fixture, options, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": f"Stage process exited with {process.exitcode}"}
+    process.join()
+    # The metrics directory is bookkeeping, not pipeline output.
+    shutil.rmtree(os.path.join(workdir, "metrics"), ignore_errors=True)
+    result["disk_bytes"] = disk_bytes(workdir)
+    if not options["keep"]:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def environment() -> Dict:
+    def output(cmd: List[str]) -> Optional[str]:
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout.splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            return None
+    return {
+        "commit": output(["git", "rev-parse", "HEAD"]),
+        "python": sys.version.split()[0],
+        "ffmpeg": output(["ffmpeg", "-hide_banner", "-version"]),
+        "cpus": os.cpu_count(),
+        "timestamp": time.time(),
+    }
+
+
+def compare(baseline: Dict, current: Dict) -> None:
+    def key(run: Dict):
+        return tuple(run[name] for name in ("fixture", "stage", "accurate", "audio_only"))
+    previous = {}
+    for run in baseline["runs"]:
+        previous.setdefault(key(run), []).append(run)
+    print(f"{'fixture':<40} {'stage':<9} {'wall':>9} {'base':>9} {'change':>8}")
+    for run in current["runs"]:
+        runs = previous.get(key(run))
+        if not runs or run["error"] or run["repeat"] != 0:
+            continue
+        wall = median(current, run)
+        base = sorted(r["wall_s"] for r in runs)[len(runs) // 2]
+        change = (wall - base) / base * 100 if base else 0.0
+        print(f"{run['fixture']:<40} {run['stage']:<9} {wall:>8.3f}s {base:>8.3f}s {change:>+7.1f}%")
+
+
+def median(results: Dict, run: Dict) -> float:
+    walls = sorted(r["wall_s"] for r in results["runs"]
+                   if r["fixture"] == run["fixture"] and r["stage"] == run["stage"] and not r["error"])
+    return walls[len(walls) // 2]
+
+
+def parse_list(value: str, kind=str) -> List:
+    return [kind(item) for item in value.split(",") if item]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", default="60", help="comma-separated fixture durations in seconds")
+    parser.add_argument("--chapters", default="8", help="comma-separated chapter counts")
+    parser.add_argument("--video-codecs", default="libx264", help="comma-separated ffmpeg video encoders")
+    parser.add_argument("--audio-codecs", default="aac", help="comma-separated ffmpeg audio encoders")
+    parser.add_argument("--resolution", default="1280x720")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--gop-seconds", type=int, default=2, help="keyframe interval of the fixtures")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--accurate", action="store_true", help="benchmark frame-accurate cuts")
+    parser.add_argument("--audio-only", action="store_true")
+    parser.add_argument("--fixtures", default=os.path.join("bench", "fixtures"))
+    parser.add_argument("--workdir", default=os.path.join("bench", "runs"))
+    parser.add_argument("--keep", action="store_true", help="keep each stage's scratch directory")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="print wall time changes against an earlier JSON result")
+    args = parser.parse_args()
+
+    stages = parse_list(args.stages)
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage: {stage}")
+    os.makedirs(args.fixtures, exist_ok=True)
+    os.makedirs(args.workdir, exist_ok=True)
+    options = {
+        "accurate": args.accurate,
+        "audio_only": args.audio_only,
+        "workdir": args.workdir,
+        "keep": args.keep,
+        "repo": os.path.dirname(os.path.abspath(__file__)),
+    }
+
+    server = serve_fixtures(args.fixtures)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    results = {"environment": environment(), "options": vars(args), "runs": []}
+    try:
+        for duration in parse_list(args.durations, float):
+            for chapter_count in parse_list(args.chapters, int):
+                for video_codec in parse_list(args.video_codecs):
+                    for audio_codec in parse_list(args.audio_codecs):
+                        config = {
+                            "duration": int(duration) if duration.is_integer() else duration,
+                            "chapters": chapter_count, "video_codec": video_codec,
+                            "audio_codec": audio_codec, "resolution": args.resolution,
+                            "fps": args.fps, "gop_seconds": args.gop_seconds,
+                        }
+                        fixture = make_fixture(args.fixtures, config)
+                        url = f"{base_url}/{fixture['page']}"
+                        for repeat in range(args.repeat):
+                            for stage in stages:
+                                result = measure(stage, url, fixture, options)
+                                run = {"fixture": fixture["name"], **config, "stage": stage,
+                                       "repeat": repeat, "accurate": args.accurate,
+                                       "audio_only": args.audio_only, **result}
+                                results["runs"].append(run)
+                                status = f"error: {run['error']}" if run["error"] else \
+                                    f"{run['wall_s']:.3f}s wall, {run['cpu_user_s'] + run['cpu_sys_s']:.3f}s cpu"
+                                print(f"{fixture['name']} {stage} #{repeat}: {status}")
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+METADATA_CACHE_PATH = os.environ.get("METADATA_CACHE_PATH", os.path.join("cache", "metadata.sqlite3"))
+# Format URLs handed out by YouTube expire after a few hours, so entries must
+# not outlive them.
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", "3600"))
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get("METADATA_CACHE_MAX_ENTRIES", "5000"))
+
+
+class MetadataCache:
+    """SQLite-backed TTL/LRU cache shared by every worker process on the host."""
+
+    def __init__(self, path: str = METADATA_CACHE_PATH, ttl: int = METADATA_CACHE_TTL,
+                 max_entries: int = METADATA_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections cannot be shared between threads, and must not
+        # survive a fork, so keep one per (process, thread).
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " key TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS metadata_accessed_at ON metadata (accessed_at)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Dict]:
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT payload, expires_at FROM metadata WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        payload, expires_at = row
+        if expires_at <= now:
+            conn.execute("DELETE FROM metadata WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE metadata SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(payload)
+
+    def set(self, key: str, value: Dict) -> None:
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO metadata (key, payload, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + self.ttl, now),
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM metadata WHERE expires_at <= ?", (now,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM metadata").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM metadata WHERE key IN"
+                " (SELECT key FROM metadata ORDER BY accessed_at LIMIT ?)",
+                (overflow,),
+            )
@@ -0,0 +1,19 @@
+import os
+import shutil
+
+# Read by gunicorn from the working directory. Runs in the master before
+# any worker imports the app, so every worker shares this metrics directory.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join("temp", ".metrics"))
+
+
+def on_starting(server):
+    # Samples left by the processes of a previous server would otherwise be
+    # summed into every scrape.
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+import zlib
+import shutil
+from typing import Dict, List, Optional, Set, Tuple
+
+from jobs import TEMP_ROOT, JOB_FILE, file_lock, read_json, write_json, is_job_id, is_orphaned
+from store import STORE_ROOT, SOURCE_FILE, ContentStore
+
+JANITOR_MAX_BYTES = int(os.environ.get("JANITOR_MAX_BYTES", str(20 * 1024 ** 3)))
+JANITOR_HIGH_WATERMARK = float(os.environ.get("JANITOR_HIGH_WATERMARK", "0.9"))
+JANITOR_LOW_WATERMARK = float(os.environ.get("JANITOR_LOW_WATERMARK", "0.7"))
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "60"))
+# A lease older than this belongs to a worker that died mid-response.
+LEASE_TTL = float(os.environ.get("LEASE_TTL", str(6 * 3600)))
+# Partial source downloads are kept this long so a retry can resume them.
+PARTIAL_SOURCE_TTL = float(os.environ.get("PARTIAL_SOURCE_TTL", str(24 * 3600)))
+
+LAST_ACCESS_FILE = ".last_access"
+LEASE_PREFIX = ".lease-"
+# Lease creation and job eviction serialise on one of these, next to the
+# job directories: a lock file inside a job would go away with it.
+LEASE_LOCK_DIR = ".leases"
+LEASE_LOCK_STRIPES = 64
+STATS_FILE = "janitor.json"
+
+
+def touch_access(directory: str) -> None:
+    path = os.path.join(directory, LAST_ACCESS_FILE)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        open(path, "a").close()
+
+
+def job_lock(directory: str):
+    # crc32 rather than hash(): it must agree across processes.
+    root, name = os.path.split(os.path.normpath(directory))
+    os.makedirs(os.path.join(root, LEASE_LOCK_DIR), exist_ok=True)
+    stripe = zlib.crc32(name.encode()) % LEASE_LOCK_STRIPES
+    return file_lock(os.path.join(root, LEASE_LOCK_DIR, f"stripe-{stripe}.lock"))
+
+
+def acquire_lease(directory: str) -> Optional[str]:
+    # Marks a job directory as being read (a download or stream in flight),
+    # which the janitor never evicts. None if the job is already gone.
+    with job_lock(directory):
+        if not os.path.isdir(directory):
+            return None
+        path = os.path.join(directory, f"{LEASE_PREFIX}{os.getpid()}-{uuid.uuid4().hex}")
+        open(path, "w").close()
+        touch_access(directory)
+    return path
+
+
+def release_lease(path: Optional[str]) -> None:
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _tree_files(path: str):
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                yield os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+
+
+def _tree_last_access(path: str) -> float:
+    return max((stat.st_mtime for stat in _tree_files(path)), default=os.path.getmtime(path))
+
+
+class Janitor:
+    def __init__(self, temp_root: str = TEMP_ROOT, store: Optional[ContentStore] = None,
+                 max_bytes: int = JANITOR_MAX_BYTES):
+        self.temp_root = temp_root
+        self.store = store or ContentStore(STORE_ROOT)
+        self.max_bytes = max_bytes
+        self.stats_path = os.path.join(self.store.root, STATS_FILE)
+
+    def stats(self) -> Dict:
+        return read_json(self.stats_path) or {
+            "runs": 0, "evicted_jobs": 0, "evicted_objects": 0, "bytes_freed": 0,
+            "usage_bytes": None, "last_run": None,
+        }
+
+    def usage(self) -> int:
+        # Hardlinked objects are counted once.
+        seen: Set[Tuple[int, int]] = set()
+        total = 0
+        for root in (self.temp_root, self.store.root):
+            for stat in _tree_files(root):
+                key = (stat.st_dev, stat.st_ino)
+                if key not in seen:
+                    seen.add(key)
+                    total += stat.st_blocks * 512
+        return total
+
+    def _job_busy(self, path: str) -> bool:
+        job = read_json(os.path.join(path, JOB_FILE))
+        if job and job.get("status") in ("queued", "running") and not is_orphaned(job):
+            return True
+        now = time.time()
+        for name in os.listdir(path):
+            if name.startswith(LEASE_PREFIX):
+                try:
+                    if now - os.path.getmtime(os.path.join(path, name)) < LEASE_TTL:
+                        return True
+                except FileNotFoundError:
+                    continue
+        return False
+
+    def _idle_jobs(self) -> List[Tuple[float, str]]:
+        jobs = []
+        if not os.path.isdir(self.temp_root):
+            return jobs
+        for name in os.listdir(self.temp_root):
+            path = os.path.join(self.temp_root, name)
+            if not is_job_id(name) or not os.path.isdir(path) or self._job_busy(path):
+                continue
+            marker = os.path.join(path, LAST_ACCESS_FILE)
+            last_access = os.path.getmtime(marker) if os.path.exists(marker) else _tree_last_access(path)
+            jobs.append((last_access, path))
+        return sorted(jobs)
+
+    def _unreferenced_objects(self) -> List[Tuple[float, str, str]]:
+        # (last access, path, lock key) for store objects no job links to.
+        objects = []
+        renders = os.path.join(self.store.root, "renders")
+        for root, _, names in os.walk(renders):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if stat.st_nlink == 1:
+                    objects.append((stat.st_mtime, path, name.split(".")[0]))
+        sources = os.path.join(self.store.root, "sources")
+        if os.path.isdir(sources):
+            now = time.time()
+            for key in os.listdir(sources):
+                path = os.path.join(sources, key)
+                stats = list(_tree_files(path))
+                complete = os.path.exists(os.path.join(path, SOURCE_FILE))
+                last_access = max((stat.st_mtime for stat in stats), default=os.path.getmtime(path))
+                if not complete and now - last_access < PARTIAL_SOURCE_TTL:
+                    continue
+                if complete and any(stat.st_nlink > 1 for stat in stats):
+                    continue
+                objects.append((last_access, path, key))
+        return sorted(objects)
+
+    def _referenced(self, path: str) -> bool:
+        if os.path.isdir(path):
+            return any(stat.st_nlink > 1 for stat in _tree_files(path))
+        try:
+            return os.stat(path).st_nlink > 1
+        except FileNotFoundError:
+            # Already removed; nothing to evict.
+            return True
+
+    def _remove(self, path: str) -> int:
+        # Returns the bytes actually released: blocks still linked from
+        # elsewhere stay allocated.
+        if os.path.isdir(path):
+            freed = sum(stat.st_blocks * 512 for stat in _tree_files(path) if stat.st_nlink == 1)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            stat = os.stat(path)
+            freed = stat.st_blocks * 512 if stat.st_nlink == 1 else 0
+            os.remove(path)
+        print(f"Evicted: {path}")
+        return freed
+
+    def _evict_objects(self, usage: int, target: int, stats: Dict) -> int:
+        for _, path, key in self._unreferenced_objects():
+            if usage <= target:
+                break
+            # A held lock means the object is being downloaded, stored or
+            # linked into a job right now. Links made before the lock was
+            # taken show up in the re-check.
+            with self.store.lock(key, blocking=False) as acquired:
+                if not acquired or self._referenced(path):
+                    continue
+                freed = self._remove(path)
+            usage -= freed
+            stats["bytes_freed"] += freed
+            stats["evicted_objects"] += 1
+        return usage
+
+    def run_once(self) -> Dict:
+        os.makedirs(self.store.root, exist_ok=True)
+        with file_lock(os.path.join(self.store.root, "janitor.lock"), blocking=False) as acquired:
+            if not acquired:
+                # Another worker process is already sweeping.
+                return self.stats()
+            stats = self.stats()
+            usage = self.usage()
+            high = self.max_bytes * JANITOR_HIGH_WATERMARK
+            low = self.max_bytes * JANITOR_LOW_WATERMARK
+            if usage > high:
+                usage = self._evict_objects(usage, low, stats)
+                for _, path in self._idle_jobs():
+                    if usage <= low:
+                        break
+                    # Re-checked under the lease lock: a download may have
+                    # started since the scan, and none can start meanwhile.
+                    with job_lock(path):
+                        if self._job_busy(path):
+                            continue
+                        freed = self._remove(path)
+                    usage -= freed
+                    stats["bytes_freed"] += freed
+                    stats["evicted_jobs"] += 1
+                    # The job's links are gone, so its objects may now be
+                    # unreferenced.
+                    usage = self._evict_objects(usage, low, stats)
+                usage = self.usage()
+            stats["runs"] += 1
+            stats["usage_bytes"] = usage
+            stats["last_run"] = time.time()
+            write_json(self.stats_path, stats)
+            return stats
@@ -0,0 +1,499 @@
+import os
+import json
+import uuid
+import zlib
+import time
+import fcntl
+import random
+import asyncio
+import multiprocessing
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
+
+from metrics import JOBS_FINISHED
+
+TEMP_ROOT = "temp"
+JOB_POOL_KIND = os.environ.get("JOB_POOL_KIND", "thread")
+JOB_POOL_SIZE = int(os.environ.get("JOB_POOL_SIZE", "4"))
+# Jobs wait in this process until a pool worker is free, interactive ones
+# (single requests) ahead of bulk ones (batch items).
+JOB_PRIORITIES = ("interactive", "bulk")
+# Workers bulk jobs may not take, so a single request gets one at once even
+# while batches fill the rest of the pool.
+JOB_POOL_RESERVED = int(os.environ.get("JOB_POOL_RESERVED", "1"))
+
+# Job state lives on disk next to the job's files so any gunicorn worker can
+# answer GET /api/jobs/{id}, not only the one that accepted the POST.
+JOB_FILE = "job.json"
+# Per-chapter render plan written by lazy jobs once the source is on disk.
+MANIFEST_FILE = "manifest.json"
+# Content digest of each chapter file in the job directory, by file name.
+# It names the file in the store and doubles as its ETag.
+FILES_FILE = "files.json"
+# Append-only event log per job. Subscribers in any worker process tail it,
+# and the byte offset of each line doubles as the SSE event id.
+EVENTS_FILE = "events.jsonl"
+EVENT_POLL_INTERVAL = 0.25
+# Lock files backing the host-wide concurrency slots.
+SLOT_DIR = os.path.join(TEMP_ROOT, ".slots")
+SLOT_POLL_INTERVAL = 0.1
+# Index of in-flight jobs by request key, for single-flight submission.
+# Guarded by a fixed set of lock stripes so lock files never pile up.
+INFLIGHT_DIR = os.path.join(TEMP_ROOT, ".inflight")
+INFLIGHT_LOCK_STRIPES = 64
+
+_write_lock = threading.Lock()
+
+
+class JobError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def job_dir(job_id: str) -> str:
+    return os.path.join(TEMP_ROOT, job_id)
+
+
+def is_job_id(value: str) -> bool:
+    try:
+        return str(uuid.UUID(value)) == value
+    except ValueError:
+        return False
+
+
+def read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_json(path: str, data: Dict) -> None:
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def append_line(path: str, line: bytes) -> None:
+    # A single O_APPEND write keeps lines from concurrent writers whole.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True):
+    # flock-based, so it also serialises gunicorn workers on the same host.
+    # Yields whether the lock was taken; only False when not blocking.
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _outranked(waiting_dir: str, priority: int) -> bool:
+    # Whether a live waiter with a higher priority is queued for the slot.
+    try:
+        names = os.listdir(waiting_dir)
+    except FileNotFoundError:
+        return False
+    for name in names:
+        other, pid, _ = name.split("-", 2)
+        if int(other) <= priority:
+            continue
+        if process_alive(int(pid)):
+            return True
+        try:
+            os.remove(os.path.join(waiting_dir, name))
+        except FileNotFoundError:
+            pass
+    return False
+
+
+@contextmanager
+def slot(name: str, limit: Union[int, Callable[[], int]], priority: int = 0):
+    # Host-wide semaphore: one of ``limit`` lock files, shared by every
+    # worker and job pool process. Yields the slot number. Waiters stand
+    # back while one with a higher priority is queued, so it gets the next
+    # free slot; the queue is a marker file per waiter. A callable limit is
+    # read again on every attempt. After it drops, holders of slots above it
+    # run to completion, so the new limit is only exceeded until they finish.
+    waiting_dir = os.path.join(SLOT_DIR, f"{name}.waiting")
+    os.makedirs(waiting_dir, exist_ok=True)
+    marker = None
+    try:
+        while True:
+            if not _outranked(waiting_dir, priority):
+                count = limit() if callable(limit) else limit
+                first = random.randrange(count)
+                for i in range(count):
+                    number = (first + i) % count
+                    with file_lock(os.path.join(SLOT_DIR, f"{name}-{number}.lock"), blocking=False) as acquired:
+                        if acquired:
+                            if marker is not None:
+                                os.remove(marker)
+                                marker = None
+                            yield number
+                            return
+            if marker is None:
+                marker = os.path.join(waiting_dir, f"{priority}-{os.getpid()}-{uuid.uuid4().hex}")
+                open(marker, "w").close()
+            time.sleep(SLOT_POLL_INTERVAL)
+    finally:
+        if marker is not None:
+            os.remove(marker)
+
+
+def held_slots(name: str, limit: int) -> List[int]:
+    # Holders keep an exclusive flock on their slot file, so a shared one
+    # cannot be taken on a busy slot. Free slots are locked for an instant.
+    held = []
+    for number in range(limit):
+        try:
+            f = open(os.path.join(SLOT_DIR, f"{name}-{number}.lock"))
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                held.append(number)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return held
+
+
+@contextmanager
+def slot_share(name: str, number: int, limit: int, total: int):
+    # Yields the holder of slot ``number``'s share of ``total`` units (such
+    # as cores): an even split among the slots held right now, but no more
+    # than the other holders have left, and at least one. Shares of slots
+    # whose holder died without releasing them are ignored.
+    path = os.path.join(SLOT_DIR, f"{name}.shares.json")
+    with file_lock(f"{path}.lock"):
+        held = held_slots(name, limit)
+        others = {key: share for key, share in (read_json(path) or {}).items()
+                  if int(key) in held and int(key) != number}
+        share = max(1, min(total - sum(others.values()), total // max(1, len(held))))
+        write_json(path, {**others, str(number): share})
+    try:
+        yield share
+    finally:
+        with file_lock(f"{path}.lock"):
+            shares = read_json(path) or {}
+            shares.pop(str(number), None)
+            write_json(path, shares)
+
+
+def read_job(job_id: str) -> Optional[Dict]:
+    if not is_job_id(job_id):
+        return None
+    return read_json(os.path.join(job_dir(job_id), JOB_FILE))
+
+
+def write_job(state: Dict) -> None:
+    write_json(os.path.join(job_dir(state["id"]), JOB_FILE), state)
+
+
+def read_manifest(job_id: str) -> Optional[Dict]:
+    if not is_job_id(job_id):
+        return None
+    return read_json(os.path.join(job_dir(job_id), MANIFEST_FILE))
+
+
+def write_manifest(job_id: str, manifest: Dict) -> None:
+    write_json(os.path.join(job_dir(job_id), MANIFEST_FILE), manifest)
+
+
+def read_file_keys(job_id: str) -> Dict[str, str]:
+    if not is_job_id(job_id):
+        return {}
+    return read_json(os.path.join(job_dir(job_id), FILES_FILE)) or {}
+
+
+def write_file_keys(job_id: str, keys: Dict[str, str]) -> None:
+    write_json(os.path.join(job_dir(job_id), FILES_FILE), keys)
+
+
+def add_file_key(job_id: str, filename: str, key: str) -> None:
+    # Lazily rendered files get their key as each one is rendered.
+    path = os.path.join(job_dir(job_id), FILES_FILE)
+    with file_lock(f"{path}.lock"):
+        write_json(path, {**(read_json(path) or {}), filename: key})
+
+
+def publish_event(job_id: str, event_type: str, /, **data) -> None:
+    line = json.dumps({"type": event_type, "ts": time.time(), **data}) + "\n"
+    append_line(os.path.join(job_dir(job_id), EVENTS_FILE), line.encode())
+
+
+def is_final_event(event: Dict) -> bool:
+    return event["type"] == "status" and event["status"] in ("completed", "failed")
+
+
+async def follow_events(job_id: str, offset: int = 0) -> AsyncIterator[Tuple[int, Dict]]:
+    # Yields (offset after the event, event) until the job reaches a final
+    # status. Resuming from a previously yielded offset skips nothing.
+    path = os.path.join(job_dir(job_id), EVENTS_FILE)
+    read_pos, buffer = offset, b""
+    while True:
+        try:
+            with open(path, "rb") as f:
+                f.seek(read_pos)
+                chunk = f.read()
+        except FileNotFoundError:
+            chunk = b""
+        read_pos += len(chunk)
+        buffer += chunk
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            offset += len(line) + 1
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # Only reachable when resuming from a bogus offset.
+                continue
+            yield offset, event
+            if is_final_event(event):
+                return
+        if not chunk:
+            # No final event will come from a job whose worker died or whose
+            # directory was evicted; end with a failed status instead.
+            state = read_job(job_id)
+            if state is None or is_orphaned(state):
+                error = ORPHANED_ERROR if state else {"status_code": 404, "detail": "Job no longer exists"}
+                yield offset, {"type": "status", "ts": time.time(), "status": "failed", "error": error}
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+
+class EventThrottle:
+    """Drops events of the same kind that arrive within ``interval`` seconds."""
+
+    def __init__(self, job_id: str, interval: float = 0.5):
+        self.job_id = job_id
+        self.interval = interval
+        self._last: Dict[str, float] = {}
+
+    def __call__(self, event_type: str, key: str = "", force: bool = False, **data) -> None:
+        now = time.monotonic()
+        slot = f"{event_type}:{key}"
+        if not force and now - self._last.get(slot, 0) < self.interval:
+            return
+        self._last[slot] = now
+        publish_event(self.job_id, event_type, **data)
+
+
+def update_job(job_id: str, **fields) -> Dict:
+    with _write_lock:
+        state = read_job(job_id) or {"id": job_id}
+        state.update(fields)
+        state["updated_at"] = time.time()
+        write_job(state)
+    if "status" in fields:
+        publish_event(job_id, "status", status=fields["status"], error=fields.get("error"))
+    elif fields.get("stage"):
+        publish_event(job_id, "stage", stage=fields["stage"])
+    return state
+
+
+# Reported for a job left queued or running by a worker that died.
+ORPHANED_ERROR = {"status_code": 500, "detail": "Worker exited before the job finished"}
+
+
+def is_orphaned(state: Dict) -> bool:
+    # A job left queued or running by a worker process that has since died.
+    if state.get("status") not in ("queued", "running"):
+        return False
+    pid = state.get("pid")
+    return pid is not None and not process_alive(pid)
+
+
+def create_job(payload: Dict, kind: str = "extract", **fields) -> Dict:
+    job_id = str(uuid.uuid4())
+    os.makedirs(job_dir(job_id), exist_ok=True)
+    now = time.time()
+    state = {
+        "id": job_id,
+        "kind": kind,
+        "status": "queued",
+        "stage": None,
+        "request": payload,
+        "retry_of": None,
+        "pid": os.getpid(),
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+        **fields,
+    }
+    write_job(state)
+    publish_event(job_id, "status", status="queued", error=None)
+    return state
+
+
+def count_jobs() -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    if not os.path.isdir(TEMP_ROOT):
+        return counts
+    for name in os.listdir(TEMP_ROOT):
+        state = read_job(name)
+        if state and state.get("kind") != "batch" and not is_orphaned(state):
+            counts[state["status"]] = counts.get(state["status"], 0) + 1
+    return counts
+
+
+def _run_job(fn: Callable[[str, Dict], Dict], job_id: str, payload: Dict) -> None:
+    update_job(job_id, status="running", started_at=time.time(), pid=os.getpid())
+    try:
+        result = fn(job_id, payload)
+    except JobError as e:
+        update_job(job_id, status="failed", stage=None,
+                   error={"status_code": e.status_code, "detail": e.detail})
+        JOBS_FINISHED.labels("failed").inc()
+    except Exception as e:
+        traceback.print_exc()
+        update_job(job_id, status="failed", stage=None,
+                   error={"status_code": 500, "detail": str(e)})
+        JOBS_FINISHED.labels("failed").inc()
+    else:
+        update_job(job_id, status="completed", stage=None, result=result)
+        JOBS_FINISHED.labels("completed").inc()
+
+
+def _inflight_lock(key: str) -> str:
+    # crc32 rather than hash(): it must agree across processes.
+    stripe = zlib.crc32(key.encode()) % INFLIGHT_LOCK_STRIPES
+    return os.path.join(INFLIGHT_DIR, f"stripe-{stripe}.lock")
+
+
+def _forget_inflight(key: str, job_id: str) -> None:
+    path = os.path.join(INFLIGHT_DIR, f"{key}.json")
+    with file_lock(_inflight_lock(key)):
+        entry = read_json(path)
+        if entry and entry["job_id"] == job_id:
+            os.remove(path)
+
+
+class JobManager:
+    def __init__(self, kind: str = JOB_POOL_KIND, size: int = JOB_POOL_SIZE):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown job pool kind: {kind}")
+        self.kind = kind
+        self.size = size
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._queues = {priority: deque() for priority in JOB_PRIORITIES}
+        self._running = {priority: 0 for priority in JOB_PRIORITIES}
+        self._closed = False
+        self._queue_lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        # Created on first use so a preloading gunicorn master never forks
+        # with a live pool.
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    # Spawned, not forked: this process already runs threads
+                    # (event loop helpers, download fragments) whose locks a
+                    # fork would copy in whatever state they are in.
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.size, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="job")
+            return self._executor
+
+    def submit(self, fn: Callable[[str, Dict], Dict], payload: Dict, retry_of: Optional[str] = None,
+               on_done: Optional[Callable[[str], None]] = None, **fields) -> Dict:
+        state = create_job(payload, retry_of=retry_of, **fields)
+        self.run(fn, state["id"], payload, on_done)
+        return state
+
+    def submit_once(self, key: str, fn: Callable[[str, Dict], Dict], payload: Dict,
+                    **fields) -> Tuple[Dict, bool]:
+        # Returns (job, attached): identical submissions while a job for
+        # ``key`` is queued or running, from any worker process, get that
+        # job instead of a new one.
+        os.makedirs(INFLIGHT_DIR, exist_ok=True)
+        path = os.path.join(INFLIGHT_DIR, f"{key}.json")
+        with file_lock(_inflight_lock(key)):
+            entry = read_json(path)
+            job = read_job(entry["job_id"]) if entry else None
+            if job and job["status"] in ("queued", "running") and not is_orphaned(job):
+                return job, True
+            state = self.submit(fn, payload, on_done=lambda job_id: _forget_inflight(key, job_id), **fields)
+            write_json(path, {"job_id": state["id"]})
+            return state, False
+
+    def run(self, fn: Callable[[str, Dict], Dict], job_id: str, payload: Dict,
+            on_done: Optional[Callable[[str], None]] = None, priority: str = "interactive") -> None:
+        # Runs a job already created with create_job(). on_done is called in
+        # this process once the job has finished, whatever its status.
+        with self._queue_lock:
+            self._queues[priority].append((fn, job_id, payload, on_done))
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        # The executor's own queue is FIFO, so it is only handed as many
+        # jobs as it has workers.
+        limits = {"interactive": self.size, "bulk": max(1, self.size - JOB_POOL_RESERVED)}
+        started = []
+        with self._queue_lock:
+            while not self._closed and sum(self._running.values()) < self.size:
+                priority = next((priority for priority in JOB_PRIORITIES
+                                 if self._queues[priority] and self._running[priority] < limits[priority]), None)
+                if priority is None:
+                    break
+                started.append((priority, *self._queues[priority].popleft()))
+                self._running[priority] += 1
+        for priority, fn, job_id, payload, on_done in started:
+            future = self._get_executor().submit(_run_job, fn, job_id, payload)
+            future.add_done_callback(
+                lambda _, priority=priority, job_id=job_id, on_done=on_done: self._finished(priority, job_id, on_done))
+
+    def _finished(self, priority: str, job_id: str, on_done: Optional[Callable[[str], None]]) -> None:
+        with self._queue_lock:
+            self._running[priority] -= 1
+        try:
+            if on_done is not None:
+                on_done(job_id)
+        finally:
+            self._dispatch()
+
+    def shutdown(self) -> None:
+        with self._queue_lock:
+            # Jobs still queued here stay "queued" on disk and are reported
+            # as orphaned once this process is gone.
+            self._closed = True
+            for queue in self._queues.values():
+                queue.clear()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,138 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# prometheus_client's multiprocess mode: each process writes its samples to
+# mmap'd files in this directory and a scrape sums them, so counters add up
+# across gunicorn workers and job pool processes. It has to be set before
+# prometheus_client is imported. gunicorn.conf.py empties it when the
+# server (not a single worker) starts.
+METRICS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join("temp", ".metrics"))
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+STAGE_SECONDS = Histogram(
+    "chapters_stage_seconds", "Time spent in each pipeline stage.", ["stage"], buckets=STAGE_BUCKETS)
+DOWNLOADED_BYTES = Counter("chapters_downloaded_bytes", "Source media bytes downloaded.")
+SERVED_BYTES = Counter("chapters_served_bytes", "Response body bytes sent to clients.", ["route"])
+# Hit ratio: rate(..{result="hit"}) / rate(..) per cache.
+# The "inflight" cache is single-flight extraction: a hit attached to a job
+# already running.
+CACHE_LOOKUPS = Counter(
+    "chapters_cache_lookups", "Cache and in-flight job lookups.", ["cache", "result"])
+FFMPEG_FAILURES = Counter("chapters_ffmpeg_failures", "ffmpeg runs that exited with an error.", ["stage"])
+JOBS_FINISHED = Counter("chapters_jobs_finished", "Jobs that reached a final status.", ["status"])
+# signal is "429" for a refused call, "slow" for a download far below the
+# recent average throughput.
+UPSTREAM_THROTTLES = Counter(
+    "chapters_upstream_throttles", "Upstream calls that were throttled.", ["kind", "signal"])
+
+# Response paths whose time and bytes count as the "serve" stage.
+SERVE_ROUTES = {"/api/download/": "download", "/api/objects/": "download", "/api/stream/": "stream"}
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def download_counter(hook: Callable[[Dict], None],
+                     on_bytes: Optional[Callable[[int], None]] = None) -> Callable[[Dict], None]:
+    # Wraps a yt-dlp progress hook to count the bytes fetched in this run,
+    # also reported to ``on_bytes``. The first report of each file is the
+    # baseline, so bytes resumed from an earlier partial download are not
+    # counted again.
+    seen: Dict[str, int] = {}
+
+    def counting_hook(d: Dict) -> None:
+        downloaded = d.get("downloaded_bytes")
+        filename = d.get("filename")
+        if downloaded is not None and filename:
+            previous = seen.get(filename, downloaded)
+            if downloaded > previous:
+                DOWNLOADED_BYTES.inc(downloaded - previous)
+                if on_bytes is not None:
+                    on_bytes(downloaded - previous)
+            seen[filename] = max(previous, downloaded)
+        hook(d)
+    return counting_hook
+
+
+class ServeMetricsMiddleware:
+    """Times file responses and counts the body bytes actually sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        route = None
+        if scope["type"] == "http":
+            route = next((name for prefix, name in SERVE_ROUTES.items() if scope["path"].startswith(prefix)), None)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def counting_send(message):
+            if message["type"] == "http.response.body":
+                SERVED_BYTES.labels(route).inc(len(message.get("body", b"")))
+            elif message["type"] == "http.response.pathsend":
+                SERVED_BYTES.labels(route).inc(os.path.getsize(message["path"]))
+            await send(message)
+
+        with timed("serve"):
+            await self.app(scope, receive, counting_send)
+
+
+class JobCollector:
+    # Active jobs and queue depth are read from the job files at scrape
+    # time: they are shared state, not per-process samples.
+    def __init__(self, count_jobs: Callable[[], Dict[str, int]]):
+        self.count_jobs = count_jobs
+
+    def collect(self):
+        counts = self.count_jobs()
+        yield GaugeMetricFamily("chapters_jobs_active", "Jobs running right now.", value=counts.get("running", 0))
+        yield GaugeMetricFamily("chapters_jobs_queued", "Jobs waiting for a pool slot.", value=counts.get("queued", 0))
+
+
+class UpstreamCollector:
+    # The upstream limiter's current limits, from its shared state file.
+    def __init__(self, upstream_state: Callable[[], Dict]):
+        self.upstream_state = upstream_state
+
+    def collect(self):
+        state = self.upstream_state()
+        limits = GaugeMetricFamily(
+            "chapters_upstream_concurrency_limit", "Adaptive concurrency limit per upstream call kind.",
+            labels=["kind"])
+        for kind, limit in state["limits"].items():
+            limits.add_metric([kind], limit["current"])
+        yield limits
+        yield GaugeMetricFamily("chapters_upstream_tokens", "Tokens left in the upstream bucket.",
+                                value=state["tokens"])
+        yield GaugeMetricFamily("chapters_upstream_paused_seconds", "Time left in the upstream backoff pause.",
+                                value=state["paused_for"])
+
+
+def render_metrics(count_jobs: Callable[[], Dict[str, int]],
+                   upstream_state: Optional[Callable[[], Dict]] = None) -> bytes:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(JobCollector(count_jobs))
+    if upstream_state is not None:
+        registry.register(UpstreamCollector(upstream_state))
+    return generate_latest(registry)
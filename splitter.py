@@ -0,0 +1,461 @@
+import os
+import json
+import time
+import bisect
+import subprocess
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Optional
+
+from jobs import slot, slot_share
+from metrics import FFMPEG_FAILURES, timed
+from tracing import span, current_span, peak_rss_kb, wait_traced
+
+# Encodes run inside ffmpeg child processes, so a thread per in-flight
+# ffmpeg is enough to keep every core busy. The pool is shared by all jobs
+# in this process to cap the number of concurrent encoders.
+CPU_COUNT = os.cpu_count() or 1
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", "0")) or CPU_COUNT
+
+_transcode_pool = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode")
+# A pass's chapters are only ready when the whole pass ends, so the first
+# chapters get short passes of their own and reach the client early.
+LEADING_BATCH_SIZES = (1, 2)
+# ffmpeg runs allowed at once across all processes on the host, so
+# concurrent jobs share the CPUs instead of oversubscribing them.
+FFMPEG_SLOTS = int(os.environ.get("FFMPEG_SLOTS", "0")) or CPU_COUNT
+# Streamed downloads are paced by the client and can sit idle for long, so
+# they have their own limit and never hold one of the slots above. They
+# stream-copy or encode audio, so one thread each is enough.
+FFMPEG_STREAM_SLOTS = int(os.environ.get("FFMPEG_STREAM_SLOTS", "0")) or 4 * CPU_COUNT
+# Bulk work (batch items) runs niced and queues behind interactive work for
+# ffmpeg slots, so a single request is not stuck behind a playlist.
+FFMPEG_BULK_NICE = int(os.environ.get("FFMPEG_BULK_NICE", "10"))
+FFMPEG_PRIORITIES = {
+    'interactive': {'queue': 1, 'nice': 0},
+    'bulk': {'queue': 0, 'nice': FFMPEG_BULK_NICE},
+}
+
+MP3_ENCODE_ARGS = ['-acodec', 'libmp3lame', '-q:a', '2']
+
+VIDEO_COPY_ARGS = ['-c', 'copy', '-avoid_negative_ts', '1']
+# Video of chapters re-encoded in accurate mode.
+VIDEO_ENCODE_ARGS = ['-crf', '18', '-preset', 'veryfast']
+
+# Audio chapter formats. When the source's audio is already in the format's
+# codec, packets are copied into the chapter container ("copy") with no
+# decode or encode; otherwise the audio is encoded ("encode").
+AUDIO_FORMATS = {
+    'mp3': {
+        'ext': '.mp3', 'codec': 'mp3', 'copy': ['-c:a', 'copy'], 'encode': MP3_ENCODE_ARGS,
+        'stream': ['-f', 'mp3'],
+    },
+    'm4a': {
+        'ext': '.m4a', 'codec': 'aac', 'copy': ['-c:a', 'copy'], 'encode': ['-c:a', 'aac', '-b:a', '192k'],
+        'stream': ['-f', 'mp4', '-movflags', 'empty_moov+default_base_moof', '-frag_duration', '1000000'],
+    },
+    'opus': {
+        'ext': '.opus', 'codec': 'opus', 'copy': ['-c:a', 'copy'], 'encode': ['-c:a', 'libopus', '-b:a', '128k'],
+        'stream': ['-f', 'opus'],
+    },
+}
+
+def render_settings(kind: str, audio_format: str = 'mp3') -> List[str]:
+    # Everything that affects the bytes of a rendered file. Content-addressed
+    # renders are keyed on it. The source codec is not included: it is fixed
+    # by the source, which is part of the key already.
+    if kind == 'video':
+        return [*VIDEO_COPY_ARGS, '|', *VIDEO_ENCODE_ARGS]
+    spec = AUDIO_FORMATS[audio_format]
+    return [audio_format, *spec['copy'], '|', *spec['encode']]
+
+# Encoders for chapters re-encoded in accurate mode, matching the source
+# codec. Anything else is re-encoded with libx264.
+ACCURATE_CUT_ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+}
+
+
+def get_file_size(filepath: str) -> str:
+    size_bytes = os.path.getsize(filepath)
+    size_mb = size_bytes / (1024 * 1024)
+    return f"{size_mb:.2f} MB"
+
+def get_duration(start: float, end: float) -> str:
+    duration = end - start
+    hours = int(duration // 3600)
+    minutes = int((duration % 3600) // 60)
+    seconds = int(duration % 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
+
+def chapter_outputs(chapter: Dict, i: int, output_dir: str, video: bool = True,
+                    audio_format: str = 'mp3') -> Dict:
+    title = chapter.get('title', f'Chapter {i}')
+    clean_title = "".join(c if c.isalnum() else "_" for c in title)
+    return {
+        "index": i,
+        "start_time": chapter['start_time'],
+        "end_time": chapter.get('end_time'),
+        "path": os.path.join(output_dir, f"{i}_{clean_title}.mp4") if video else None,
+        "audio_path": os.path.join(output_dir, f"{i}_{clean_title}{AUDIO_FORMATS[audio_format]['ext']}"),
+        "audio_format": audio_format,
+    }
+
+def parse_progress(block: Dict[str, str]) -> Dict:
+    out_time_us = block.get('out_time_us') or block.get('out_time_ms')
+    speed = block.get('speed', '').rstrip('x').strip()
+    total_size = block.get('total_size', '')
+    return {
+        "out_time": int(out_time_us) / 1_000_000 if out_time_us and out_time_us.lstrip('-').isdigit() else None,
+        "speed": float(speed) if speed and speed != 'N/A' else None,
+        "total_size": int(total_size) if total_size.isdigit() else None,
+        "progress": block.get('progress'),
+    }
+
+def ffmpeg_stage(outputs: List[Dict]) -> str:
+    # A pass that encodes audio is dominated by the encode; pure stream-copy
+    # passes are cuts.
+    return 'transcode' if any(output['audio_path'] and not output.get('audio_copy') for output in outputs) else 'cut'
+
+@contextmanager
+def ffmpeg_slot(priority: str = 'interactive'):
+    # Takes a host-wide ffmpeg slot and yields the run's thread budget: the
+    # cores split evenly among the runs holding slots, capped at what the
+    # others left. A run keeps its budget to the end, so a lone run gets
+    # every core and runs started meanwhile get what is left, at least one.
+    queued = time.perf_counter()
+    with slot('ffmpeg', FFMPEG_SLOTS, FFMPEG_PRIORITIES[priority]['queue']) as number, \
+            slot_share('ffmpeg', number, FFMPEG_SLOTS, CPU_COUNT) as threads:
+        current_span().set(queue_seconds=time.perf_counter() - queued, threads=threads, priority=priority)
+        yield threads
+
+@contextmanager
+def stream_slot():
+    # Like ffmpeg_slot, for an ffmpeg run piped to a client; its budget is
+    # always one thread.
+    with slot('ffmpeg-stream', FFMPEG_STREAM_SLOTS):
+        yield 1
+
+def budget_command(cmd: List[str], threads: int) -> List[str]:
+    # -threads before an input caps its decoder, before -c:v the video
+    # encoder. Stream copies and the audio encoders used here are
+    # single-threaded anyway.
+    budgeted = [cmd[0]]
+    for arg in cmd[1:]:
+        if arg in ('-i', '-c:v'):
+            budgeted += ['-threads', str(threads)]
+        budgeted.append(arg)
+    return budgeted
+
+def niced(cmd: List[str], nice: int) -> List[str]:
+    # Through nice(1), so the priority is set before ffmpeg starts any
+    # threads; preexec_fn is not safe in a threaded process.
+    return ['nice', '-n', str(nice), *cmd] if nice else cmd
+
+def run_ffmpeg(cmd: List[str], on_progress: Optional[Callable[[Dict], None]] = None,
+               stage: str = 'cut', priority: str = 'interactive') -> None:
+    try:
+        with ffmpeg_slot(priority) as threads, timed(stage):
+            _run_ffmpeg(budget_command(cmd, threads), on_progress, FFMPEG_PRIORITIES[priority]['nice'])
+    except subprocess.CalledProcessError:
+        FFMPEG_FAILURES.labels(stage).inc()
+        raise
+
+def _run_ffmpeg(cmd: List[str], on_progress: Optional[Callable[[Dict], None]] = None,
+                nice: int = 0) -> None:
+    if on_progress is not None:
+        # -progress writes key=value blocks terminated by a progress= line.
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+    cmd = niced(cmd, nice)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE if on_progress else None, text=True)
+    peak_kb = 0
+    if on_progress is not None:
+        block = {}
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            block[key] = value
+            if key == 'progress':
+                on_progress(parse_progress(block))
+                block = {}
+                peak_kb = peak_rss_kb(process.pid)
+    returncode = wait_traced(process, peak_kb)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def probe_codecs(input_path: str) -> Dict[str, str]:
+    # Codec of the first stream of each type, from the container headers.
+    streams = json.loads(subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', input_path],
+        check=True, capture_output=True, text=True,
+    ).stdout).get('streams', [])
+    codecs = {}
+    for stream in streams:
+        codecs.setdefault(stream.get('codec_type'), stream.get('codec_name'))
+    return codecs
+
+def probe_media(input_path: str, audio_only: bool = False) -> Dict:
+    # Reads the packet index once; only packet flags are inspected, nothing
+    # is decoded.
+    codecs = probe_codecs(input_path)
+    codec = None if audio_only else codecs.get('video')
+    if not codec:
+        return {"video_codec": None, "audio_codec": codecs.get('audio'), "keyframes": []}
+
+    packets = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+         '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_path],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    keyframes = []
+    for line in packets.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    keyframes.sort()
+    return {"video_codec": codec, "audio_codec": codecs.get('audio'), "keyframes": keyframes}
+
+def plan_cuts(outputs: List[Dict], media: Dict, accurate: bool = False) -> None:
+    # Every chapter gets its own input-side seek to the last keyframe at or
+    # before its start, so ffmpeg jumps straight there instead of demuxing
+    # the file from the beginning. Stream-copied video can only start on a
+    # keyframe; accurate mode re-encodes chapters that start mid-GOP instead.
+    keyframes = media["keyframes"]
+    for output in outputs:
+        start = output['start_time']
+        position = bisect.bisect_right(keyframes, start + 0.001)
+        seek = keyframes[position - 1] if position else 0
+        if not keyframes:
+            seek = start
+        output['seek'] = seek
+        output['reencode'] = bool(output['path']) and accurate and bool(keyframes) and start - seek > 0.001
+        # Audio already in the chapter format's codec is copied, not re-encoded.
+        if output['audio_path']:
+            output['audio_copy'] = media.get('audio_codec') == AUDIO_FORMATS[output['audio_format']]['codec']
+
+def audio_args(output: Dict) -> List[str]:
+    spec = AUDIO_FORMATS[output['audio_format']]
+    return spec['copy'] if output.get('audio_copy') else spec['encode']
+
+def build_split_command(input_path: str, outputs: List[Dict]) -> List[str]:
+    # A single ffmpeg process handles the whole batch: each chapter is its own
+    # seeked input, so the file is read once in total however many chapters
+    # there are. The MP4 is a packet-level copy from the keyframe and the
+    # audio file trims the remaining lead-in: after decoding when encoding,
+    # to the nearest packet when copying.
+    cmd = ['ffmpeg', '-hide_banner', '-y']
+    for output in outputs:
+        seek = output.get('seek', output['start_time'])
+        cmd += ['-ss', str(seek)]
+        if output['end_time']:
+            cmd += ['-t', str(output['end_time'] - seek)]
+        cmd += ['-i', input_path]
+    for k, output in enumerate(outputs):
+        if output['path'] and not output.get('reencode'):
+            cmd += ['-map', f'{k}:v:0?', '-map', f'{k}:a:0?', *VIDEO_COPY_ARGS, output['path']]
+        if output['audio_path']:
+            lead_in = output['start_time'] - output.get('seek', output['start_time'])
+            cmd += ['-map', f'{k}:a:0', '-ss', f'{lead_in:.3f}',
+                    '-vn', *audio_args(output), output['audio_path']]
+    return cmd
+
+def accurate_cut(input_path: str, output: Dict, video_codec: Optional[str], priority: str = 'interactive') -> None:
+    try:
+        with span('accurate_cut', chapters=[output['index']]), ffmpeg_slot(priority) as threads, timed('transcode'):
+            _accurate_cut(input_path, output, video_codec, threads, FFMPEG_PRIORITIES[priority]['nice'])
+    except subprocess.CalledProcessError:
+        FFMPEG_FAILURES.labels('transcode').inc()
+        if os.path.exists(output['path']):
+            os.remove(output['path'])
+        raise
+
+def _accurate_cut(input_path: str, output: Dict, video_codec: Optional[str], threads: int, nice: int = 0) -> None:
+    # The whole chapter is re-encoded. Re-encoding only the partial GOP and
+    # joining it to a stream copy of the rest does not work: the encoder's
+    # parameter sets differ from the source's, and an MP4 track has one.
+    start, end = output['start_time'], output['end_time']
+    cmd = ['ffmpeg', '-hide_banner', '-y', '-ss', str(start)]
+    if end:
+        cmd += ['-t', str(end - start)]
+    cmd += ['-i', input_path, '-map', '0:v:0?', '-map', '0:a:0?',
+            '-c:v', ACCURATE_CUT_ENCODERS.get(video_codec, 'libx264'), *VIDEO_ENCODE_ARGS,
+            '-c:a', 'copy', output['path']]
+    _run_ffmpeg(budget_command(cmd, threads), nice=nice)
+    check_decodes(output['path'], threads, nice)
+
+def check_decodes(path: str, threads: int, nice: int = 0) -> None:
+    # Decodes the file to nowhere; -xerror makes any decode error fail the
+    # run, so a broken render is never stored.
+    _run_ffmpeg(budget_command(['ffmpeg', '-hide_banner', '-v', 'error', '-xerror', '-i', path, '-f', 'null', '-'],
+                               threads), nice=nice)
+
+def describe_output(output: Dict) -> Dict:
+    return {
+        "index": output["index"],
+        "path": output["path"],
+        "audio_path": output["audio_path"],
+        "audio_format": output["audio_format"],
+        "size": get_file_size(output["path"] or output["audio_path"]),
+        "duration": get_duration(output["start_time"], output["end_time"]) if output["end_time"] else None,
+    }
+
+def plan_batches(outputs: List[Dict], count: int) -> List[List[Dict]]:
+    # Contiguous runs of chapters with roughly equal total duration, one per
+    # worker, so each ffmpeg pass covers a single stretch of the input.
+    count = max(1, min(count, len(outputs)))
+    if count == 1:
+        return [outputs]
+    lengths = [max((output['end_time'] or output['start_time'] + 1) - output['start_time'], 0.001)
+               for output in outputs]
+    target = sum(lengths) / count
+    batches, current, filled = [], [], 0.0
+    for output, length in zip(outputs, lengths):
+        remaining_outputs = len(outputs) - len(current) - sum(len(batch) for batch in batches)
+        remaining_batches = count - len(batches)
+        if current and len(batches) < count - 1 and (
+                filled + length / 2 > target or remaining_outputs < remaining_batches):
+            batches.append(current)
+            current, filled = [], 0.0
+        current.append(output)
+        filled += length
+    batches.append(current)
+    return batches
+
+def plan_leading_batches(outputs: List[Dict], count: int) -> List[List[Dict]]:
+    batches = []
+    for size in LEADING_BATCH_SIZES:
+        if len(outputs) <= size:
+            break
+        batches.append(outputs[:size])
+        outputs = outputs[size:]
+    return batches + plan_batches(outputs, count)
+
+def cut_outputs(input_path: str, outputs: List[Dict], video_codec: Optional[str] = None,
+                on_progress: Optional[Callable[[Dict], None]] = None, priority: str = 'interactive') -> None:
+    # One ffmpeg pass over ``outputs`` plus the re-encodes it leaves, traced
+    # as one span: the chapters of a pass share a process, so their CPU
+    # time cannot be told apart.
+    stage = ffmpeg_stage(outputs)
+    with span(stage, chapters=[output['index'] for output in outputs]) as trace:
+        # A pass whose only outputs are re-encoded video has nothing to
+        # copy; ffmpeg refuses a command without outputs.
+        if any(output['audio_path'] or (output['path'] and not output.get('reencode')) for output in outputs):
+            run_ffmpeg(build_split_command(input_path, outputs), on_progress, stage, priority)
+        for output in outputs:
+            if output.get('reencode'):
+                accurate_cut(input_path, output, video_codec, priority)
+        trace.set(bytes_out=sum(os.path.getsize(path) for output in outputs
+                                for path in (output['path'], output['audio_path']) if path))
+
+def split_batch(input_path: str, outputs: List[Dict], video_codec: Optional[str] = None,
+                on_progress: Optional[Callable[[List[int], Dict], None]] = None,
+                on_chapter: Optional[Callable[[Dict], None]] = None,
+                priority: str = 'interactive') -> List[Dict]:
+    def finish(output: Dict) -> Dict:
+        file = describe_output(output)
+        if on_chapter is not None:
+            on_chapter(file)
+        return file
+
+    def progress_for(batch: List[Dict]) -> Optional[Callable[[Dict], None]]:
+        if on_progress is None:
+            return None
+        indices = [output['index'] for output in batch]
+        return lambda progress: on_progress(indices, progress)
+
+    try:
+        cut_outputs(input_path, outputs, video_codec, progress_for(outputs), priority)
+        return [finish(output) for output in outputs]
+    except subprocess.CalledProcessError as e:
+        if len(outputs) == 1:
+            print(f"Error processing chapter {outputs[0]['index']}: {e}")
+            return []
+        print(f"Batch split failed, retrying chapters one by one: {e}")
+
+    # A bad chapter must not take the others down with it.
+    output_files = []
+    for output in outputs:
+        try:
+            cut_outputs(input_path, [output], video_codec, progress_for([output]), priority)
+            output_files.append(finish(output))
+        except subprocess.CalledProcessError as e:
+            print(f"Error processing chapter {output['index']}: {e}")
+    return output_files
+
+def probe_source(input_path: str, audio_only: bool = False) -> Dict:
+    # Audio seeks are sample-exact, so only video needs the keyframe index.
+    try:
+        with span('probe'):
+            return probe_media(input_path, audio_only)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"Error probing source, falling back to exact seeks and encoding: {e}")
+    return {"video_codec": None, "audio_codec": None, "keyframes": []}
+
+def render_chapter_file(input_path: str, output: Dict, kind: str, media: Dict,
+                        accurate: bool = False) -> str:
+    # Renders one file of one chapter. The result is written under a
+    # temporary name and renamed into place, so a reader never sees a
+    # partially written chapter.
+    output = dict(output)
+    final_path = output['path'] if kind == 'video' else output['audio_path']
+    base, ext = os.path.splitext(final_path)
+    tmp_path = f"{base}.partial-{os.getpid()}{ext}"
+    if kind == 'video':
+        output['path'], output['audio_path'] = tmp_path, None
+    else:
+        output['path'], output['audio_path'] = None, tmp_path
+
+    plan_cuts([output], media, accurate)
+    try:
+        cut_outputs(input_path, [output], media["video_codec"])
+        os.replace(tmp_path, final_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return final_path
+
+def build_stream_command(input_path: str, output: Dict, kind: str, media: Dict) -> List[str]:
+    # Same cut as a rendered file, but muxed to stdout: fragmented MP4 needs
+    # no seekable output, and each audio format has a streamable muxer.
+    # Stream-copied video always starts on the previous keyframe here.
+    output = dict(output)
+    plan_cuts([output], media)
+    seek = output['seek']
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-ss', str(seek)]
+    if output['end_time']:
+        cmd += ['-t', str(output['end_time'] - seek)]
+    cmd += ['-i', input_path]
+    if kind == 'video':
+        cmd += ['-map', '0:v:0?', '-map', '0:a:0?', '-c', 'copy', '-avoid_negative_ts', '1',
+                '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', 'pipe:1']
+    else:
+        lead_in = output['start_time'] - seek
+        cmd += ['-map', '0:a:0', '-ss', f'{lead_in:.3f}', '-vn', *audio_args(output),
+                *AUDIO_FORMATS[output['audio_format']]['stream'], 'pipe:1']
+    return cmd
+
+def split_video_by_chapters(input_path: str, chapters: List[Dict], output_dir: str,
+                            accurate: bool = False, audio_only: bool = False,
+                            on_progress: Optional[Callable[[List[int], Dict], None]] = None,
+                            on_chapter: Optional[Callable[[Dict], None]] = None,
+                            audio_format: str = 'mp3', priority: str = 'interactive') -> List[Dict]:
+    outputs = [chapter_outputs(chapter, chapter.get('index', i), output_dir, not audio_only, audio_format)
+               for i, chapter in enumerate(chapters, 1)]
+    if not outputs:
+        return []
+    print(f"Splitting video by chapters with {audio_format.upper()} audio...")
+
+    media = probe_source(input_path, audio_only)
+    plan_cuts(outputs, media, accurate)
+
+    # Each batch runs in a copy of this context, so its spans land in the
+    # caller's trace.
+    futures = [_transcode_pool.submit(contextvars.copy_context().run, split_batch, input_path, batch,
+                                      media["video_codec"], on_progress, on_chapter, priority)
+               for batch in plan_leading_batches(outputs, TRANSCODE_WORKERS)]
+    # Collected in submission order, so results stay in chapter order.
+    output_files = []
+    for future in futures:
+        output_files.extend(future.result())
+    return output_files
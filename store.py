@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import hashlib
+from contextlib import contextmanager
+from typing import Optional
+
+from jobs import file_lock, read_json, write_json
+
+STORE_ROOT = os.environ.get("STORE_ROOT", "store")
+
+# Content-addressed home for downloaded sources and rendered chapter files.
+# Jobs hardlink objects into their own temp/<job> directory, so an object's
+# reference count is simply its link count minus the store's own link.
+SOURCE_FILE = "source.json"
+# Renders are stored under the digest of their bytes, which their ETag and
+# immutable URL are built from; this index maps render keys to digests.
+RENDER_INDEX = "render_keys"
+
+
+def object_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:40]
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:40]
+
+
+def link_or_copy(src: str, dest: str) -> None:
+    if os.path.exists(dest):
+        return
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        pass
+    except OSError:
+        # Different filesystem; fall back to a copy, renamed into place.
+        tmp_path = f"{dest}.{os.getpid()}.tmp"
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+
+
+def touch(path: str) -> None:
+    # mtime doubles as the last-access time for eviction; noatime mounts make
+    # st_atime useless. Hardlinks share the inode, so any link refreshes it.
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def refcount(path: str) -> int:
+    try:
+        return os.stat(path).st_nlink - 1
+    except FileNotFoundError:
+        return 0
+
+
+class ContentStore:
+    def __init__(self, root: str = STORE_ROOT):
+        self.root = root
+
+    def _dir(self, *parts: str) -> str:
+        path = os.path.join(self.root, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @contextmanager
+    def lock(self, key: str, blocking: bool = True):
+        with file_lock(os.path.join(self._dir("locks"), f"{key}.lock"), blocking) as acquired:
+            yield acquired
+
+    def source_dir(self, key: str) -> str:
+        return self._dir("sources", key)
+
+    def get_sources(self, key: str) -> Optional[list]:
+        # Paths of a completed download, or None while absent or partial.
+        record = read_json(os.path.join(self.root, "sources", key, SOURCE_FILE))
+        if not record or not all(os.path.exists(path) for path in record["paths"]):
+            return None
+        for path in record["paths"]:
+            touch(path)
+        return record["paths"]
+
+    def put_sources(self, key: str, paths: list) -> None:
+        # yt-dlp copies the upstream Last-Modified into mtime; reset it so the
+        # janitor sees the download as fresh.
+        for path in paths:
+            touch(path)
+        write_json(os.path.join(self.source_dir(key), SOURCE_FILE), {"paths": paths})
+
+    def render_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self._dir("renders", digest[:2]), f"{digest}{ext}")
+
+    def _render_index(self, key: str) -> str:
+        return os.path.join(self._dir(RENDER_INDEX, key[:2]), f"{key}.json")
+
+    def get_object(self, digest: str, ext: str) -> Optional[str]:
+        path = self.render_path(digest, ext)
+        if not os.path.exists(path):
+            return None
+        touch(path)
+        return path
+
+    def link_render(self, key: str, dest: str) -> Optional[str]:
+        # Links the stored render for a render key to ``dest`` and returns its
+        # digest, or None if never stored or evicted. The object's lock keeps
+        # the janitor from evicting it between the lookup and the link.
+        record = read_json(self._render_index(key))
+        if not record:
+            return None
+        with self.lock(record["digest"]):
+            path = self.get_object(record["digest"], os.path.splitext(dest)[1])
+            if not path:
+                return None
+            link_or_copy(path, dest)
+        return record["digest"]
+
+    def put_render(self, key: str, path: str) -> str:
+        # Stores a rendered file under the digest of its bytes, returned.
+        digest = file_digest(path)
+        with self.lock(digest):
+            link_or_copy(path, self.render_path(digest, os.path.splitext(path)[1]))
+        write_json(self._render_index(key), {"digest": digest})
+        return digest
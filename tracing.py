@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import select
+import resource
+import threading
+import subprocess
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+
+from jobs import job_dir, file_lock, is_job_id, append_line
+
+# Spans of each job, one JSON line per finished span, next to its events.
+TRACE_FILE = "trace.jsonl"
+# Every span from every job, for profiling across jobs. Rotated by size and
+# kept after the job directories themselves are evicted.
+TRACE_LOG = os.environ.get("TRACE_LOG", "traces.jsonl")
+TRACE_LOG_MAX_BYTES = int(os.environ.get("TRACE_LOG_MAX_BYTES", str(50 * 1024 ** 2)))
+TRACE_LOG_BACKUPS = int(os.environ.get("TRACE_LOG_BACKUPS", "3"))
+
+# Linux only; elsewhere thread CPU falls back to the whole process.
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+# A traced child's peak RSS is sampled while it runs, at intervals doubling
+# up to this so short runs get samples too.
+RSS_SAMPLE_INTERVAL = 0.25
+
+_job: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_job", default=None)
+_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    """A timed step of a job. Child processes reaped inside it add their
+    rusage under "children"; callers add attributes such as bytes moved.
+    """
+
+    def __init__(self, job_id: str, name: str, attrs: Dict):
+        self.record = {"job_id": job_id, "name": name, "start": time.time(), **attrs}
+        self._lock = threading.Lock()
+
+    def set(self, **attrs) -> None:
+        with self._lock:
+            self.record.update(attrs)
+
+    def add(self, key: str, amount: float) -> None:
+        # Called from yt-dlp's fragment threads as well.
+        with self._lock:
+            self.record[key] = self.record.get(key, 0) + amount
+
+    def add_child_usage(self, usage: resource.struct_rusage, peak_rss_kb: int) -> None:
+        with self._lock:
+            children = self.record.setdefault("children", {
+                "count": 0, "cpu_user": 0.0, "cpu_sys": 0.0, "max_rss_kb": 0, "read_bytes": 0, "write_bytes": 0,
+            })
+            children["count"] += 1
+            children["cpu_user"] += usage.ru_utime
+            children["cpu_sys"] += usage.ru_stime
+            children["max_rss_kb"] = max(children["max_rss_kb"], peak_rss_kb)
+            # Block I/O: reads served from the page cache do not count.
+            children["read_bytes"] += usage.ru_inblock * 512
+            children["write_bytes"] += usage.ru_oublock * 512
+
+
+class _NoSpan:
+    # Stands in outside a traced job, so callers need not check.
+    def set(self, **attrs) -> None:
+        pass
+
+    def add(self, key: str, amount: float) -> None:
+        pass
+
+
+@contextmanager
+def trace_context(job_id: str):
+    # Spans opened inside, in this thread or in work submitted with
+    # copy_context(), belong to ``job_id``.
+    token = _job.set(job_id)
+    try:
+        yield
+    finally:
+        _job.reset(token)
+
+
+def traced_job(fn: Callable[[str, Dict], Dict]) -> Callable[[str, Dict], Dict]:
+    # Runs a job function under its trace, with a root "job" span.
+    @wraps(fn)
+    def wrapper(job_id: str, payload: Dict) -> Dict:
+        with trace_context(job_id), span("job"):
+            return fn(job_id, payload)
+    return wrapper
+
+
+@contextmanager
+def span(name: str, **attrs):
+    job_id = _job.get()
+    if job_id is None:
+        yield _NoSpan()
+        return
+    current = Span(job_id, name, attrs)
+    parent = _span.get()
+    if parent is not None:
+        current.set(parent=parent.record["name"])
+    token = _span.set(current)
+    started = time.perf_counter()
+    usage = resource.getrusage(RUSAGE_THREAD)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=f"{type(e).__name__}: {e}"[:500])
+        raise
+    finally:
+        _span.reset(token)
+        end_usage = resource.getrusage(RUSAGE_THREAD)
+        current.set(
+            duration=time.perf_counter() - started,
+            cpu_user=end_usage.ru_utime - usage.ru_utime,
+            cpu_sys=end_usage.ru_stime - usage.ru_stime,
+            # Peak of the whole worker process: a thread has none of its own.
+            max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        )
+        try:
+            write_span(current.record)
+        except OSError as e:
+            print(f"Error writing trace span: {e}")
+
+
+def current_span():
+    return _span.get() or _NoSpan()
+
+
+def peak_rss_kb(pid: int) -> int:
+    # High-water RSS of a running child, 0 once it has exited. ru_maxrss
+    # from wait4 cannot be used: Linux carries the forking parent's peak
+    # over exec, so every child would report the worker's size.
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def wait_traced(process: subprocess.Popen, peak_kb: int = 0) -> int:
+    # Waits for ``process`` and charges its CPU time, peak RSS and block I/O
+    # to the innermost open span. The peak is sampled until exit, so growth
+    # in the last sample interval can be missed.
+    current = _span.get()
+    if current is None:
+        return process.wait()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # No pidfd (not Linux, or a kernel before 5.3): wait4 blocks right
+        # away, so the peak comes from /proc samples taken before, if any.
+        pidfd = None
+    if pidfd is not None:
+        interval = 0.01
+        try:
+            while not select.select([pidfd], [], [], interval)[0]:
+                peak_kb = max(peak_kb, peak_rss_kb(process.pid))
+                interval = min(interval * 2, RSS_SAMPLE_INTERVAL)
+        finally:
+            os.close(pidfd)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    current.add_child_usage(usage, peak_kb)
+    return process.returncode
+
+
+def _rotated(number: int) -> str:
+    return f"{TRACE_LOG}.{number}" if number else TRACE_LOG
+
+
+def write_span(record: Dict) -> None:
+    line = (json.dumps(record) + "\n").encode()
+    if os.path.isdir(job_dir(record["job_id"])):
+        append_line(os.path.join(job_dir(record["job_id"]), TRACE_FILE), line)
+    # Rotation renames files under the lock so no writer appends to a file
+    # that is being moved away.
+    with file_lock(f"{TRACE_LOG}.lock"):
+        try:
+            full = os.path.getsize(TRACE_LOG) + len(line) > TRACE_LOG_MAX_BYTES
+        except FileNotFoundError:
+            full = False
+        if full:
+            for number in range(TRACE_LOG_BACKUPS, 0, -1):
+                if os.path.exists(_rotated(number - 1)):
+                    os.replace(_rotated(number - 1), _rotated(number))
+        append_line(TRACE_LOG, line)
+
+
+def _read_lines(path: str, containing: str = "") -> List[Dict]:
+    # Lines without ``containing`` are skipped unparsed.
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if containing in line and line.endswith("\n")]
+    except FileNotFoundError:
+        return []
+
+
+def read_trace(job_id: str) -> Optional[List[Dict]]:
+    # Spans in the order they finished, or None when nothing was recorded.
+    if not is_job_id(job_id):
+        return None
+    spans = _read_lines(os.path.join(job_dir(job_id), TRACE_FILE))
+    if not spans:
+        # Evicted job: fall back to the shared log, oldest file first.
+        for number in range(TRACE_LOG_BACKUPS, -1, -1):
+            spans += [record for record in _read_lines(_rotated(number), job_id) if record.get("job_id") == job_id]
+    return spans or None
@@ -0,0 +1,192 @@
+import os
+import re
+import time
+import random
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, TypeVar
+
+from jobs import TEMP_ROOT, file_lock, read_json, write_json, slot
+from metrics import UPSTREAM_THROTTLES
+
+# Calls to the video site (metadata, playlist listings, media downloads)
+# from every worker process on the host share one token bucket and one
+# adaptive concurrency limit per kind of call, so a burst of jobs does not
+# get the shared cookies throttled. The state is a JSON file under flock.
+UPSTREAM_STATE_FILE = os.path.join(TEMP_ROOT, ".upstream.json")
+# Sustained calls per second, and how many may go out back to back.
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", "2"))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", "10"))
+# Ceilings of the adaptive concurrency limits. The limits halve when the
+# upstream throttles and grow back by one per limit's worth of successes.
+UPSTREAM_MAX_CONCURRENCY = {
+    "metadata": int(os.environ.get("UPSTREAM_METADATA_SLOTS", "8")),
+    "download": int(os.environ.get("DOWNLOAD_SLOTS", "4")),
+}
+# Throttled calls are retried after a pause shared by all processes:
+# Retry-After when the upstream sends one, otherwise exponential backoff
+# with full jitter.
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "4"))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", "2"))
+UPSTREAM_BACKOFF_MAX = float(os.environ.get("UPSTREAM_BACKOFF_MAX", "120"))
+# A download this much slower than the recent average counts as throttled
+# bandwidth. Small downloads are latency-bound and are not compared.
+UPSTREAM_SLOW_RATIO = float(os.environ.get("UPSTREAM_SLOW_RATIO", "0.2"))
+UPSTREAM_THROUGHPUT_MIN_BYTES = 4 * 1024 * 1024
+
+THROTTLED_PATTERN = re.compile(r"HTTP Error 429|Too Many Requests")
+
+T = TypeVar("T")
+
+
+def _error_chain(error: Optional[BaseException]) -> Iterator[BaseException]:
+    # yt-dlp wraps the HTTP error in DownloadError.exc_info or
+    # ExtractorError.cause rather than chaining it.
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        exc_info = getattr(error, "exc_info", None)
+        error = ((exc_info[1] if isinstance(exc_info, tuple) else None)
+                 or getattr(error, "cause", None) or error.__cause__ or error.__context__)
+
+
+def is_throttled(error: BaseException) -> bool:
+    return any(getattr(e, "status", None) == 429 or getattr(e, "code", None) == 429
+               or THROTTLED_PATTERN.search(str(e)) for e in _error_chain(error))
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    # Only the delay-seconds form; an HTTP date falls back to backoff.
+    for e in _error_chain(error):
+        response = getattr(e, "response", None)
+        headers = getattr(response, "headers", None) or getattr(e, "headers", None)
+        value = headers.get("Retry-After") if headers is not None else None
+        if value and value.strip().isdigit():
+            return float(value)
+    return None
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF * 2 ** attempt))
+
+
+class UpstreamLimiter:
+    """Token bucket plus AIMD concurrency limits for upstream calls, shared
+    by every process on the host.
+
+    A throttled call (HTTP 429, or a download far below the recent average
+    throughput) halves the limit of its kind, at most once per backoff
+    base. A 429 also pauses every call until the backoff has passed.
+    """
+
+    def __init__(self, path: str = UPSTREAM_STATE_FILE):
+        self.path = path
+
+    def _initial(self) -> Dict:
+        return {
+            "tokens": UPSTREAM_BURST, "updated": time.time(), "paused_until": 0.0, "decreased_at": 0.0,
+            "limits": {kind: float(limit) for kind, limit in UPSTREAM_MAX_CONCURRENCY.items()},
+            "throughput": None, "throttled": 0,
+        }
+
+    @contextmanager
+    def _update(self) -> Iterator[Dict]:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with file_lock(f"{self.path}.lock"):
+            state = read_json(self.path) or self._initial()
+            now = time.time()
+            state["tokens"] = min(UPSTREAM_BURST, state["tokens"] + (now - state["updated"]) * UPSTREAM_RATE)
+            state["updated"] = now
+            yield state
+            write_json(self.path, state)
+
+    def _limit(self, kind: str) -> int:
+        state = read_json(self.path) or self._initial()
+        return max(1, int(state["limits"][kind]))
+
+    def _decrease(self, state: Dict, kind: str) -> None:
+        # Calls already in flight when the upstream pushed back report it
+        # too; one decrease answers all of them.
+        if time.time() - state["decreased_at"] < UPSTREAM_BACKOFF:
+            return
+        state["limits"][kind] = max(1.0, state["limits"][kind] / 2)
+        state["decreased_at"] = time.time()
+
+    def _take_token(self) -> None:
+        while True:
+            with self._update() as state:
+                if state["paused_until"] > state["updated"]:
+                    delay = state["paused_until"] - state["updated"]
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return
+                else:
+                    delay = (1 - state["tokens"]) / UPSTREAM_RATE
+            # Spread the waiters released at the same moment.
+            time.sleep(delay + random.uniform(0, 1 / UPSTREAM_RATE))
+
+    def _succeeded(self, kind: str, size: Optional[int], seconds: float) -> None:
+        with self._update() as state:
+            limit = state["limits"][kind]
+            throughput = size / seconds if size and size >= UPSTREAM_THROUGHPUT_MIN_BYTES and seconds > 0 else None
+            average = state["throughput"]
+            if throughput is not None and average and throughput < UPSTREAM_SLOW_RATIO * average:
+                UPSTREAM_THROTTLES.labels(kind, "slow").inc()
+                state["throttled"] += 1
+                self._decrease(state, kind)
+            else:
+                state["limits"][kind] = min(float(UPSTREAM_MAX_CONCURRENCY[kind]), limit + 1 / limit)
+            if throughput is not None:
+                state["throughput"] = throughput if average is None else 0.8 * average + 0.2 * throughput
+
+    def _throttled(self, kind: str, attempt: int, error: BaseException) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            delay = backoff(attempt)
+        UPSTREAM_THROTTLES.labels(kind, "429").inc()
+        with self._update() as state:
+            state["throttled"] += 1
+            self._decrease(state, kind)
+            state["paused_until"] = max(state["paused_until"], state["updated"] + delay)
+            # The bucket restarts empty, so calls resume at the sustained rate.
+            state["tokens"] = 0.0
+        return delay
+
+    def call(self, kind: str, fn: Callable[[], T], size: Optional[Callable[[T], int]] = None) -> T:
+        # Runs fn under the limits of ``kind`` and feeds the outcome back.
+        # Throttled attempts are retried; other errors are raised as they are.
+        # ``size`` gives the bytes a result transferred, for throughput.
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            with slot(f"upstream-{kind}", lambda: self._limit(kind)):
+                self._take_token()
+                started = time.monotonic()
+                try:
+                    result = fn()
+                except Exception as e:
+                    if not is_throttled(e):
+                        raise
+                    delay = self._throttled(kind, attempt, e)
+                    if attempt == UPSTREAM_RETRIES:
+                        raise
+                    print(f"Upstream throttled the {kind} call, retrying in {delay:.1f}s")
+                    continue
+                seconds = time.monotonic() - started
+            try:
+                transferred = size(result) if size is not None and result else None
+            except OSError:
+                transferred = None
+            self._succeeded(kind, transferred, seconds)
+            return result
+
+    def state(self) -> Dict:
+        with self._update() as state:
+            return {
+                "rate": UPSTREAM_RATE,
+                "burst": UPSTREAM_BURST,
+                "tokens": state["tokens"],
+                "paused_for": max(0.0, state["paused_until"] - state["updated"]),
+                "limits": {kind: {"current": max(1, int(limit)), "max": UPSTREAM_MAX_CONCURRENCY[kind]}
+                           for kind, limit in state["limits"].items()},
+                "throughput": state["throughput"],
+                "throttled": state["throttled"],
+            }
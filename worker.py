@@ -1,18 +1,71 @@
 import os
-import uuid
-import subprocess
+import re
 import time
 import shutil
+import json
+import asyncio
+import threading
+import traceback
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager
 from pathlib import Path
-from typing import List, Dict, Optional
-from fastapi import FastAPI, HTTPException
+from typing import Callable, Iterator, List, Dict, Literal, Optional, Tuple, Union
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from urllib.parse import quote
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from sse_starlette.sse import EventSourceResponse
 from pydantic import BaseModel
-import yt_dlp
 
-app = FastAPI()
+from cache import MetadataCache
+from ytdl import YoutubeDLPool, import_yt_dlp
+from upstream import UpstreamLimiter
+from jobs import (JobManager, JobError, job_dir, read_job, update_job, is_job_id, is_orphaned, create_job,
+                  ORPHANED_ERROR,
+                  read_manifest, write_manifest, file_lock, follow_events, EventThrottle,
+                  publish_event, is_final_event, count_jobs, read_file_keys, write_file_keys,
+                  add_file_key)
+from metrics import (ServeMetricsMiddleware, CONTENT_TYPE_LATEST, FFMPEG_FAILURES, timed,
+                     cache_lookup, download_counter, render_metrics)
+from tracing import span, trace_context, traced_job, read_trace
+from zipstream import ZipStream
+from store import ContentStore, object_key, link_or_copy
+from janitor import Janitor, JANITOR_INTERVAL, acquire_lease, release_lease
+from splitter import (split_video_by_chapters, chapter_outputs, get_duration,
+                      probe_source, render_chapter_file, build_stream_command,
+                      describe_output, render_settings, stream_slot, budget_command, niced,
+                      FFMPEG_PRIORITIES)
+
+job_manager = JobManager()
+janitor = Janitor()
+
+async def janitor_loop():
+    while True:
+        try:
+            await asyncio.to_thread(janitor.run_once)
+        except Exception as e:
+            print(f"Janitor run failed: {e}")
+        await asyncio.sleep(JANITOR_INTERVAL)
+
+async def warm_ytdl():
+    try:
+        await asyncio.to_thread(ydl_pool.warm, METADATA_OPTIONS)
+    except Exception as e:
+        print(f"YoutubeDL warm-up failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    janitor_task = asyncio.create_task(janitor_loop())
+    warm_task = asyncio.create_task(warm_ytdl()) if YTDL_WARM else None
+    yield
+    janitor_task.cancel()
+    if warm_task is not None:
+        warm_task.cancel()
+    job_manager.shutdown()
+    ydl_pool.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,194 +73,1015 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ServeMetricsMiddleware)
 
 class VideoRequest(BaseModel):
     url: str
+    # Optional subset of chapters to extract, given as 1-based indices or
+    # chapter titles. Only the media covering these chapters is downloaded.
+    chapters: Optional[List[Union[int, str]]] = None
+    # Frame-accurate chapter starts: chapters starting between keyframes
+    # are re-encoded instead of snapping back to the previous keyframe.
+    accurate_cuts: bool = False
+    # "audio" downloads only the audio stream and produces audio files alone.
+    output: Literal["both", "audio"] = "both"
+    # Container and codec of the audio chapter files. m4a (AAC) and opus
+    # copy the source's audio untouched when it is already in that codec;
+    # mp3 is encoded unless the source is MP3.
+    audio_format: Literal["mp3", "m4a", "opus"] = "mp3"
+    # "lazy" returns download URLs as soon as metadata is known and renders
+    # each chapter file on its first download. "stream" does the same but
+    # pipes every download straight from ffmpeg without writing it to disk.
+    render: Literal["eager", "lazy", "stream"] = "eager"
+
+class BatchRequest(BaseModel):
+    # Video or playlist URLs. Playlists are expanded and repeated videos
+    # are extracted once. Options apply to every item.
+    urls: List[str]
+    accurate_cuts: bool = False
+    output: Literal["both", "audio"] = "both"
+    audio_format: Literal["mp3", "m4a", "opus"] = "mp3"
+    render: Literal["eager", "lazy", "stream"] = "eager"
+
+VIDEO_FORMAT = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/best'
+# Audio-only sources picked per chapter format, so the chapter files can be
+# stream copies. Video sources keep their m4a audio (MP4 cannot always hold
+# opus), so opus chapters cut from video are encoded.
+AUDIO_SOURCE_FORMATS = {'opus': 'bestaudio[acodec=opus]/bestaudio/best'}
+
+# Fragments (DASH/HLS) fetched in parallel per download.
+DOWNLOAD_CONCURRENT_FRAGMENTS = int(os.environ.get("DOWNLOAD_CONCURRENT_FRAGMENTS", "4"))
+# Progressive downloads are fetched in ranged requests of this size, so an
+# interrupted transfer only loses the chunk in flight.
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(10 * 1024 * 1024)))
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", "10"))
+# Optional external downloader for parallel range fetches ("aria2c").
+DOWNLOAD_EXTERNAL = os.environ.get("DOWNLOAD_EXTERNAL", "")
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+# Items of one batch handed to the job pool at a time; the rest wait in the
+# batch and are fed in as items finish, so concurrent batches share the pool.
+BATCH_ITEMS_IN_FLIGHT = int(os.environ.get("BATCH_ITEMS_IN_FLIGHT", "2"))
+
+METADATA_OPTIONS = {
+    'format': VIDEO_FORMAT,
+    'quiet': True,
+    'extract_flat': False,
+    'no_warnings': True,
+    'cookiefile': 'cookies.txt'
+}
+# Playlists are listed without resolving every entry.
+FLAT_OPTIONS = {**METADATA_OPTIONS, 'extract_flat': 'in_playlist'}
+# Build the metadata YoutubeDL in the background once a worker is up, so
+# the first request does not pay for it and boot does not either.
+YTDL_WARM = os.environ.get("YTDL_WARM", "1") == "1"
+
+metadata_cache = MetadataCache()
+ydl_pool = YoutubeDLPool()
+# Every call to the video site goes through this; see upstream.py.
+upstream = UpstreamLimiter()
+content_store = ContentStore()
+
+def video_cache_key(url: str) -> str:
+    # Resolve the extractor's video id from the URL alone so that every
+    # spelling of a link (youtu.be, watch?v=, shorts, extra query params)
+    # shares one cache entry without a network round trip.
+    for ie in import_yt_dlp().extractor.gen_extractor_classes():
+        if ie.ie_key() != 'Generic' and ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            if video_id:
+                return f"{ie.ie_key()}:{video_id}"
+            break
+    return f"url:{url}"
+
+def project_video_info(info: Dict) -> Dict:
+    formats = info.get('requested_formats') or [info]
+    return {
+        'id': info.get('id'),
+        'extractor_key': info.get('extractor_key'),
+        'webpage_url': info.get('webpage_url'),
+        'title': info.get('title'),
+        'thumbnail': info.get('thumbnail'),
+        'duration': info.get('duration'),
+        'chapters': info.get('chapters'),
+        'format_urls': [f['url'] for f in formats if f.get('url')],
+    }
+
+def fetch_info(url: str, options: Dict) -> Dict:
+    with ydl_pool.get(options) as ydl:
+        return ydl.extract_info(url, download=False)
 
 def get_video_info(url: str) -> Optional[Dict]:
+    key = video_cache_key(url)
+    cached = metadata_cache.get(key)
+    cache_lookup("metadata", cached is not None)
+    if cached is not None:
+        return cached
+
     print("Fetching video metadata...")
-    ydl_opts = {
-        'quiet': True,
-        'extract_flat': False,
-        'no_warnings': True,
-        'cookiefile': 'cookies.txt'
-    }
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.extract_info(url, download=False)
+        with timed("metadata"):
+            info = project_video_info(upstream.call("metadata", lambda: fetch_info(url, METADATA_OPTIONS)))
     except Exception as e:
         print(f"Error fetching video info: {e}")
         return None
 
+    metadata_cache.set(key, info)
+    return info
 
+def download_options() -> Dict:
+    # Partial files (.part plus yt-dlp's .ytdl fragment state) stay in the
+    # store's deterministic source directory, so a retried job picks the
+    # download up from the bytes already on disk.
+    options = {
+        'continuedl': True,
+        'concurrent_fragment_downloads': DOWNLOAD_CONCURRENT_FRAGMENTS,
+        'http_chunk_size': DOWNLOAD_CHUNK_SIZE,
+        'retries': DOWNLOAD_RETRIES,
+        'fragment_retries': DOWNLOAD_RETRIES,
+    }
+    if DOWNLOAD_EXTERNAL == 'aria2c' and shutil.which('aria2c'):
+        options['external_downloader'] = {'http': 'aria2c'}
+        options['external_downloader_args'] = {'aria2c': [
+            '--continue=true', f'--max-connection-per-server={DOWNLOAD_CONNECTIONS}',
+            f'--split={DOWNLOAD_CONNECTIONS}', '--min-split-size=1M', '--file-allocation=none',
+        ]}
+    return options
 
-def get_video_chapters(url: str) -> Optional[List[Dict]]: 
-    print("Checking for video chapters...")
-    info = get_video_info(url)
-    if info and 'chapters' in info:
-        return info['chapters']
-    return None
+def media_format(audio_only: bool, audio_format: str = "mp3") -> str:
+    if not audio_only:
+        return VIDEO_FORMAT
+    return AUDIO_SOURCE_FORMATS.get(audio_format, AUDIO_FORMAT)
 
-def download_video(url: str, temp_dir: str) -> Optional[str]:
-    print("Downloading full video...")
-    ydl_opts = {
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-        'outtmpl': os.path.join(temp_dir, 'full_video.%(ext)s'),
+def media_options(audio_only: bool, audio_format: str = "mp3") -> Dict:
+    return {
+        'format': media_format(audio_only, audio_format),
         'quiet': True,
-        'cookiefile': 'cookies.txt'
+        'cookiefile': 'cookies.txt',
+        **download_options(),
     }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+
+def download_video(url: str, temp_dir: str, audio_only: bool = False,
+                   progress_hook: Optional[Callable[[Dict], None]] = None,
+                   audio_format: str = "mp3") -> Optional[str]:
+    print("Downloading full audio..." if audio_only else "Downloading full video...")
+    outtmpl = os.path.join(temp_dir, 'full_audio.%(ext)s' if audio_only else 'full_video.%(ext)s')
+
+    def download() -> str:
+        with ydl_pool.get(media_options(audio_only, audio_format), outtmpl=outtmpl,
+                          progress_hook=progress_hook) as ydl:
             info = ydl.extract_info(url, download=True)
             return ydl.prepare_filename(info)
+    try:
+        return upstream.call("download", download, size=os.path.getsize)
     except Exception as e:
         print(f"Error downloading video: {e}")
         return None
 
+def download_video_sections(url: str, temp_dir: str, sections: List[Dict], audio_only: bool = False,
+                            progress_hook: Optional[Callable[[Dict], None]] = None,
+                            audio_format: str = "mp3") -> Optional[List[str]]:
+    print(f"Downloading {len(sections)} video section(s)...")
+    ranges = import_yt_dlp().utils.download_range_func(None, [(section['start'], section['end']) for section in sections])
 
-def get_file_size(filepath: str) -> str:
-    size_bytes = os.path.getsize(filepath)
-    size_mb = size_bytes / (1024 * 1024)
-    return f"{size_mb:.2f} MB"
-
-def get_duration(start: float, end: float) -> str:
-    duration = end - start
-    hours = int(duration // 3600)
-    minutes = int((duration % 3600) // 60)
-    seconds = int(duration % 60)
-    return f"{hours:02}:{minutes:02}:{seconds:02}"
-
-def split_video_by_chapters(input_path: str, chapters: List[Dict], output_dir: str) -> List[Dict]:
-    print("Splitting video by chapters and converting to MP3...")
-    output_files = []
-
-    for i, chapter in enumerate(chapters, 1):
-        start_time = chapter['start_time']
-        end_time = chapter.get('end_time')
-        title = chapter.get('title', f'Chapter {i}')
-        clean_title = "".join(c if c.isalnum() else "_" for c in title)
-
-        mp4_output_path = os.path.join(output_dir, f"{i}_{clean_title}.mp4")
-        mp3_output_path = os.path.join(output_dir, f"{i}_{clean_title}.mp3")
-
-        mp4_cmd = [
-            'ffmpeg',
-            '-i', input_path,
-            '-ss', str(start_time),
-            '-to', str(end_time) if end_time else None,
-            '-c', 'copy',
-            '-avoid_negative_ts', '1',
-            '-y',
-            mp4_output_path
-        ]
-        mp4_cmd = [arg for arg in mp4_cmd if arg is not None]
+    def download() -> Dict:
+        with ydl_pool.get(media_options(audio_only, audio_format),
+                          outtmpl=os.path.join(temp_dir, 'section_%(section_start)d.%(ext)s'),
+                          download_ranges=ranges, progress_hook=progress_hook) as ydl:
+            return ydl.extract_info(url, download=True)
 
-        try:
-            subprocess.run(mp4_cmd, check=True)
-
-            mp3_cmd = [
-                'ffmpeg',
-                '-i', mp4_output_path,
-                '-vn',
-                '-acodec', 'libmp3lame',
-                '-q:a', '2',
-                '-y',
-                mp3_output_path
-            ]
-            subprocess.run(mp3_cmd, check=True)
+    def size(info: Dict) -> int:
+        return sum(os.path.getsize(requested['filepath']) for requested in info.get('requested_downloads') or [])
+    try:
+        info = upstream.call("download", download, size)
+    except Exception as e:
+        print(f"Error downloading video sections: {e}")
+        return None
 
-            size = get_file_size(mp4_output_path)
-            duration = get_duration(start_time, end_time)
+    paths = {}
+    for download in info.get('requested_downloads') or []:
+        paths[round(download.get('section_start') or 0)] = download['filepath']
+    try:
+        return [paths[round(section['start'])] for section in sections]
+    except KeyError:
+        print("Error downloading video sections: missing section output")
+        return None
+
+def select_chapters(chapters: List[Dict], selection: Optional[List[Union[int, str]]]) -> List[Dict]:
+    indexed = [{**chapter, 'index': i} for i, chapter in enumerate(chapters, 1)]
+    if not selection:
+        return indexed
 
-            output_files.append({
-                "path": mp4_output_path,
-                "mp3_path": mp3_output_path,
-                "size": size,
-                "duration": duration
+    by_title = {chapter.get('title', '').casefold(): chapter for chapter in indexed}
+    selected = {}
+    for item in selection:
+        if isinstance(item, int):
+            if not 1 <= item <= len(indexed):
+                raise JobError(400, f"Chapter index out of range: {item}")
+            chapter = indexed[item - 1]
+        else:
+            chapter = by_title.get(item.casefold())
+            if chapter is None:
+                raise JobError(400, f"Chapter not found: {item}")
+        selected[chapter['index']] = chapter
+    return [selected[index] for index in sorted(selected)]
+
+def plan_sections(chapters: List[Dict], total_chapters: int) -> Optional[List[Dict]]:
+    # Consecutive chapters are merged into one time range so that a
+    # contiguous selection is fetched as a single section. None means the
+    # selection covers the whole video and a plain download is cheaper.
+    if len(chapters) == total_chapters:
+        return None
+    sections = []
+    for chapter in chapters:
+        last = sections[-1] if sections else None
+        if last and last['chapters'][-1]['index'] == chapter['index'] - 1:
+            last['end'] = chapter.get('end_time')
+            last['chapters'].append(chapter)
+        else:
+            sections.append({
+                'start': chapter['start_time'],
+                'end': chapter.get('end_time'),
+                'chapters': [chapter],
             })
+    for section in sections:
+        if section['end'] is None:
+            section['end'] = float('inf')
+    return sections
 
-        except subprocess.CalledProcessError as e:
-            print(f"Error processing chapter {i}: {e}")
-
-    return output_files
-
-@app.get("/api/extract-progress/{url}")
-async def extract_video_progress(url: str):
-    def event_generator():
-        yield f"data: Downloading video...\n\n"
-        time.sleep(2)
-        yield f"data: Fetching video metadata...\n\n"
-        time.sleep(2)
-        yield f"data: Extracting chapters...\n\n"
-        time.sleep(2)
-        yield f"data: Converting chapters to MP3...\n\n"
-        time.sleep(2)
+@app.get("/api/extract-progress/{job_id}")
+async def extract_video_progress(job_id: str, request: Request):
+    if not read_job(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    last_event_id = request.headers.get("last-event-id", "0")
+    offset = int(last_event_id) if last_event_id.isdigit() else 0
+
+    async def event_generator():
+        async for next_offset, event in follow_events(job_id, offset):
+            yield {"id": str(next_offset), "event": event["type"], "data": json.dumps(event)}
     return EventSourceResponse(event_generator())
 
-@app.post("/api/extract")
-async def api_extract_chapters(request: VideoRequest):  
-    temp_dir = os.path.join("temp", str(uuid.uuid4()))
-    os.makedirs(temp_dir, exist_ok=True)
+def download_progress_hook(publish: EventThrottle) -> Callable[[Dict], None]:
+    def hook(d: Dict) -> None:
+        filename = os.path.basename(d.get('filename') or '')
+        publish("download", key=filename, force=d['status'] != 'downloading',
+                status=d['status'],
+                filename=filename,
+                downloaded_bytes=d.get('downloaded_bytes'),
+                total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+                speed=d.get('speed'),
+                eta=d.get('eta'))
+    return hook
 
-    try:
-        chapters = get_video_chapters(request.url)
-        if not chapters:
-            raise HTTPException(status_code=400, detail="No chapters found in this video")
+def split_progress_hook(publish: EventThrottle) -> Callable[[List[int], Dict], None]:
+    def hook(indices: List[int], progress: Dict) -> None:
+        publish("split", key=str(indices[0]), force=progress['progress'] == 'end',
+                chapters=indices, **progress)
+    return hook
+
+LAZY_RENDER_TIMEOUT = float(os.environ.get("LAZY_RENDER_TIMEOUT", "900"))
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "public, no-cache"
+OBJECT_KEY_PATTERN = re.compile(r"[0-9a-f]{40}")
+CHAPTER_MEDIA_TYPES = {".mp4": "video/mp4", ".mp3": "audio/mp3", ".m4a": "audio/mp4", ".opus": "audio/ogg"}
+# "x-accel" (nginx) or "x-sendfile" (Apache, lighttpd): downloads answer
+# with a header naming the file and the proxy serves it.
+SENDFILE_MODE = os.environ.get("SENDFILE_MODE", "")
+# nginx internal location aliased to this app's working directory.
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX", "/protected/")
+
+def download_url(temp_dir: str, path: Optional[str], route: str = "download") -> Optional[str]:
+    if not path:
+        return None
+    return f"/api/{route}/{os.path.basename(temp_dir)}/{os.path.basename(path)}"
+
+def object_url(path: Optional[str], keys: Dict[str, str]) -> Optional[str]:
+    # Content-addressed URL of a stored chapter file, cacheable forever.
+    key = path and keys.get(os.path.basename(path))
+    if not key:
+        return None
+    return f"/api/objects/{key}{os.path.splitext(path)[1]}?filename={quote(os.path.basename(path))}"
+
+def chapter_entry(temp_dir: str, chapter: Dict, file: Dict, route: str = "download",
+                  keys: Optional[Dict[str, str]] = None) -> Dict:
+    entry = {
+        "title": chapter["title"],
+        "start_time": chapter["start_time"],
+        "end_time": chapter.get("end_time"),
+        "size": file["size"],
+        "duration": file["duration"],
+        "mp4_download_url": download_url(temp_dir, file['path'], route),
+        "audio_download_url": download_url(temp_dir, file['audio_path'], route),
+        "audio_format": file['audio_format'],
+    }
+    if file['audio_format'] == "mp3":
+        # Older clients only know this name.
+        entry["mp3_download_url"] = entry["audio_download_url"]
+    if keys:
+        entry["mp4_object_url"] = object_url(file['path'], keys)
+        entry["audio_object_url"] = object_url(file['audio_path'], keys)
+    return entry
+
+def local_chapters(chapters: List[Dict], offset: float) -> List[Dict]:
+    # Section files start at their own zero, so shift chapter times.
+    return [
+        {
+            **chapter,
+            'start_time': chapter['start_time'] - offset,
+            'end_time': chapter['end_time'] - offset if chapter.get('end_time') is not None else None,
+        }
+        for chapter in chapters
+    ]
+
+def source_key(url: str, video_info: Dict, audio_only: bool, sections: Optional[List[Dict]],
+               audio_format: str = "mp3") -> str:
+    video_key = f"{video_info['extractor_key']}:{video_info['id']}" if video_info.get('id') else url
+    ranges = [(section['start'], section['end']) for section in sections] if sections else None
+    return object_key(video_key, media_format(audio_only, audio_format), ranges)
+
+def render_key(source: str, source_path: str, output: Dict, kind: str, accurate: bool) -> str:
+    return object_key(source, os.path.basename(source_path), output['start_time'], output['end_time'],
+                      kind, render_settings(kind, output['audio_format']), accurate)
+
+def fetch_sources(url: str, key: str, sections: Optional[List[Dict]], audio_only: bool,
+                  progress_hook: Callable[[Dict], None], temp_dir: str,
+                  audio_format: str = "mp3") -> Optional[List[str]]:
+    # Returns the sources linked into ``temp_dir``. The lock is held across
+    # the download, so a second request for the same media waits for the
+    # first and then reuses its files, and across the linking, so the
+    # janitor cannot evict them before the job's own links exist.
+    with content_store.lock(key):
+        paths = content_store.get_sources(key)
+        cache_lookup("source", paths is not None)
+        if paths is not None:
+            print("Reusing stored source media...")
+            return link_sources(paths, temp_dir)
+        dest = content_store.source_dir(key)
+        # yt-dlp runs in this thread, so the span's CPU time is extraction
+        # and download bookkeeping; the bytes come from the progress hook.
+        with span("download", sections=len(sections) if sections else None) as trace:
+            progress_hook = download_counter(progress_hook, lambda count: trace.add("bytes_in", count))
+            with timed("download"):
+                if sections is None:
+                    path = download_video(url, dest, audio_only, progress_hook, audio_format)
+                    paths = [path] if path else None
+                else:
+                    paths = download_video_sections(url, dest, sections, audio_only, progress_hook, audio_format)
+            if paths:
+                trace.set(bytes_out=sum(os.path.getsize(path) for path in paths))
+        if not paths:
+            return None
+        content_store.put_sources(key, paths)
+        return link_sources(paths, temp_dir)
 
+def link_sources(paths: List[str], temp_dir: str) -> List[str]:
+    # The job's own link keeps the stored source referenced while the job
+    # directory exists.
+    links = [os.path.join(temp_dir, os.path.basename(path)) for path in paths]
+    for path, link in zip(paths, links):
+        link_or_copy(path, link)
+    return links
+
+@traced_job
+def run_extraction(job_id: str, payload: Dict) -> Dict:
+    request = VideoRequest(**payload)
+    temp_dir = job_dir(job_id)
+    # Batch items are bulk work: their ffmpeg runs are niced and yield
+    # slots to single requests.
+    priority = "bulk" if (read_job(job_id) or {}).get("batch_id") else "interactive"
+
+    update_job(job_id, stage="metadata")
+    with span("metadata"):
         video_info = get_video_info(request.url)
-        if not video_info:
-            raise HTTPException(status_code=500, detail="Failed to fetch video info")
+    if not video_info:
+        raise JobError(500, "Failed to fetch video info")
+
+    chapters = video_info.get('chapters')
+    if not chapters:
+        raise JobError(400, "No chapters found in this video")
+
+    chapters = select_chapters(chapters, request.chapters)
 
-        video_title = video_info.get('title', 'No Title Found')
-        video_thumbnail = video_info.get('thumbnail', '')
+    video_title = video_info.get('title', 'No Title Found')
+    video_thumbnail = video_info.get('thumbnail', '')
+    publish_event(job_id, "header", title=video_title, thumbnail=video_thumbnail, chapter_count=len(chapters))
 
-        video_path = download_video(request.url, temp_dir)
-        if not video_path:
-            raise HTTPException(status_code=500, detail="Failed to download video")
+    audio_only = request.output == "audio"
+    lazy = request.render in ("lazy", "stream")
+    route = "stream" if request.render == "stream" else "download"
+    publish = EventThrottle(job_id)
 
-        chapter_files = split_video_by_chapters(video_path, chapters, temp_dir)
+    sections = plan_sections(chapters, len(video_info['chapters']))
+    if sections is None:
+        pieces = [{'offset': 0, 'chapters': local_chapters(chapters, 0)}]
+    else:
+        pieces = [{'offset': section['start'], 'chapters': local_chapters(section['chapters'], section['start'])}
+                  for section in sections]
 
-        return {
+    if lazy:
+        # File names are known up front, so the result can be published
+        # before anything is downloaded; the files are rendered on demand.
+        outputs = {}
+        for piece in pieces:
+            for chapter in piece['chapters']:
+                output = chapter_outputs(chapter, chapter['index'], temp_dir, not audio_only, request.audio_format)
+                output['duration'] = get_duration(chapter['start_time'], chapter['end_time']) if chapter.get('end_time') is not None else None
+                outputs[chapter['index']] = output
+        result = {
             "title": video_title,
             "thumbnail": video_thumbnail,
             "chapters": [
-                {
-                    "title": chapter["title"],
-                    "start_time": chapter["start_time"],
-                    "end_time": chapter.get("end_time"),
-                    "size": file["size"],
-                    "duration": file["duration"],
-                    "mp4_download_url": f"/api/download/{os.path.basename(temp_dir)}/{os.path.basename(file['path'])}",
-                    "mp3_download_url": f"/api/download/{os.path.basename(temp_dir)}/{os.path.basename(file['mp3_path'])}"
-                }
-                for chapter, file in zip(chapters, chapter_files)
+                chapter_entry(temp_dir, chapter, {**outputs[chapter['index']], "size": None}, route)
+                for chapter in chapters
             ]
         }
+        update_job(job_id, result=result)
+        for entry in result["chapters"]:
+            publish_event(job_id, "chapter", **entry)
+
+    update_job(job_id, stage="download")
+    key = source_key(request.url, video_info, audio_only, sections, request.audio_format)
+    source_paths = fetch_sources(request.url, key, sections, audio_only, download_progress_hook(publish),
+                                 temp_dir, request.audio_format)
+    if not source_paths:
+        raise JobError(500, "Failed to download video")
+    for piece, path in zip(pieces, source_paths):
+        piece['path'] = path
+
+    if lazy:
+        update_job(job_id, stage="probe")
+        files = {}
+        for piece in pieces:
+            media = probe_source(piece['path'], audio_only)
+            for chapter in piece['chapters']:
+                output = outputs[chapter['index']]
+                for kind, path in (('video', output['path']), ('audio', output['audio_path'])):
+                    if path:
+                        files[os.path.basename(path)] = {
+                            'source': piece['path'], 'kind': kind, 'output': output, 'media': media,
+                            'store_key': render_key(key, piece['path'], output, kind, request.accurate_cuts),
+                        }
+        write_manifest(job_id, {'accurate': request.accurate_cuts, 'files': files})
+        return result
+
+    chapters_by_index = {chapter["index"]: chapter for chapter in chapters}
+
+    def chapter_ready(file: Dict) -> None:
+        publish_event(job_id, "chapter", **chapter_entry(temp_dir, chapters_by_index[file["index"]], file))
+
+    update_job(job_id, stage="split")
+    chapter_files = []
+    file_keys = {}
+    # Serialised per source so concurrent jobs for the same media render
+    # each chapter once and the rest link the stored results.
+    with content_store.lock(object_key("split", key)):
+        for piece in pieces:
+            pending = []
+            for chapter in piece['chapters']:
+                output = chapter_outputs(chapter, chapter['index'], temp_dir, not audio_only, request.audio_format)
+                wanted = [(kind, path) for kind, path in (('video', output['path']), ('audio', output['audio_path'])) if path]
+                digests = [content_store.link_render(render_key(key, piece['path'], output, kind, request.accurate_cuts),
+                                                     path)
+                           for kind, path in wanted]
+                for digest in digests:
+                    cache_lookup("render", digest is not None)
+                if not all(digests):
+                    # ffmpeg truncates its outputs in place, which would
+                    # overwrite the stored objects through the links.
+                    for (_, path), digest in zip(wanted, digests):
+                        if digest:
+                            os.remove(path)
+                    pending.append(chapter)
+                    continue
+                for (_, path), digest in zip(wanted, digests):
+                    file_keys[os.path.basename(path)] = digest
+                file = describe_output(output)
+                chapter_ready(file)
+                chapter_files.append(file)
+
+            rendered = split_video_by_chapters(
+                piece['path'], pending, temp_dir, request.accurate_cuts, audio_only,
+                split_progress_hook(publish), chapter_ready, request.audio_format, priority)
+            for file in rendered:
+                chapter = next(chapter for chapter in pending if chapter['index'] == file['index'])
+                output = chapter_outputs(chapter, chapter['index'], temp_dir, not audio_only, request.audio_format)
+                for kind, path in (('video', file['path']), ('audio', file['audio_path'])):
+                    if path:
+                        file_keys[os.path.basename(path)] = content_store.put_render(
+                            render_key(key, piece['path'], output, kind, request.accurate_cuts), path)
+            chapter_files.extend(rendered)
+
+    write_file_keys(job_id, file_keys)
+    files_by_index = {file["index"]: file for file in chapter_files}
+
+    return {
+        "title": video_title,
+        "thumbnail": video_thumbnail,
+        "chapters": [
+            chapter_entry(temp_dir, chapter, file, keys=file_keys)
+            for chapter in chapters
+            if (file := files_by_index.get(chapter["index"])) is not None
+        ]
+    }
+
+async def ndjson_results(job_id: str):
+    # Header first, then one line per chapter as its files land, then the
+    # final status line.
+    yield json.dumps({"type": "job", "job_id": job_id}) + "\n"
+    async for _, event in follow_events(job_id):
+        if event["type"] in ("header", "chapter"):
+            yield json.dumps(event) + "\n"
+        elif is_final_event(event):
+            yield json.dumps({"type": "status", "status": event["status"], "error": event.get("error")}) + "\n"
+
+@app.get("/api/health")
+async def health():
+    return {"status": "ok"}
+
+def extraction_key(request: VideoRequest) -> str:
+    # Every spelling of a link normalises to the same video key, so the
+    # same video with the same options is one extraction.
+    return object_key("extract", video_cache_key(request.url), request.chapters,
+                      request.accurate_cuts, request.output, request.audio_format, request.render)
+
+def submit_extraction(request: VideoRequest, **fields) -> Tuple[Dict, bool]:
+    # Concurrent identical requests attach to the job already in flight
+    # and read their results from its event log.
+    job, attached = job_manager.submit_once(extraction_key(request), run_extraction, request.model_dump(), **fields)
+    cache_lookup("inflight", attached)
+    return job, attached
+
+@app.post("/api/extract", status_code=202)
+async def api_extract_chapters(request: VideoRequest, http_request: Request, stream: bool = False):
+    # The request key imports yt-dlp's extractors and submission takes a
+    # file lock, so both run off the event loop.
+    job, attached = await asyncio.to_thread(submit_extraction, request)
+    if stream or "application/x-ndjson" in http_request.headers.get("accept", ""):
+        return StreamingResponse(ndjson_results(job["id"]), media_type="application/x-ndjson")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/api/jobs/{job['id']}",
+        "coalesced": attached,
+    }
+
+def trace_summary(spans: List[Dict]) -> Dict[str, Dict]:
+    # Totals per span name, child processes included, to find the hot spot.
+    summary = {}
+    for record in spans:
+        entry = summary.setdefault(record["name"], {"count": 0, "duration": 0.0, "cpu": 0.0})
+        children = record.get("children", {})
+        entry["count"] += 1
+        entry["duration"] += record.get("duration", 0.0)
+        entry["cpu"] += (record.get("cpu_user", 0.0) + record.get("cpu_sys", 0.0)
+                         + children.get("cpu_user", 0.0) + children.get("cpu_sys", 0.0))
+    return summary
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = read_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "stage": job.get("stage"),
+        "error": job.get("error"),
+        "result": job.get("result"),
+    }
+
+@app.get("/api/jobs/{job_id}/trace")
+async def get_job_trace(job_id: str):
+    # Evicted jobs are looked up in the shared trace log, which can take a
+    # while, so this reads off the event loop.
+    spans = await asyncio.to_thread(read_trace, job_id)
+    if spans is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return {"job_id": job_id, "summary": trace_summary(spans), "spans": spans}
+
+@app.post("/api/jobs/{job_id}/retry", status_code=202)
+async def retry_job(job_id: str):
+    # Runs the same request again as a new job. Sources already downloaded,
+    # or partially downloaded, are resumed from the store.
+    job = read_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.get("kind") == "batch":
+        raise HTTPException(status_code=400, detail="Retry the batch's items instead")
+    if job["status"] != "failed" and not is_orphaned(job):
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    if is_orphaned(job):
+        update_job(job_id, status="failed", stage=None,
+                   error=ORPHANED_ERROR)
+    retry, attached = await asyncio.to_thread(submit_extraction, VideoRequest(**job["request"]), retry_of=job_id)
+    return {
+        "job_id": retry["id"],
+        "status": retry["status"],
+        "status_url": f"/api/jobs/{retry['id']}",
+        "retry_of": job_id,
+        "coalesced": attached,
+    }
+
+def expand_batch_urls(urls: List[str]) -> Iterator[Dict]:
+    # One flat extraction per URL, yielding its items as soon as it is
+    # done. A single video comes back fully resolved, so its metadata is
+    # cached for the item job; playlist entries are only listed here and
+    # resolved by their own jobs.
+    seen = set()
+    for url in urls:
+        try:
+            info = upstream.call("metadata", lambda: fetch_info(url, FLAT_OPTIONS))
+        except Exception as e:
+            print(f"Error expanding {url}: {e}")
+            yield {"url": url, "video_key": f"url:{url}", "title": None, "error": str(e)}
+            continue
+        if info.get('_type') == 'playlist':
+            entries = [entry for entry in info.get('entries') or [] if entry]
+        else:
+            metadata_cache.set(video_cache_key(url), project_video_info(info))
+            entries = [{**info, 'url': url}]
+        for entry in entries:
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if not entry_url:
+                continue
+            ie_key = entry.get('ie_key') or entry.get('extractor_key')
+            video_key = f"{ie_key}:{entry['id']}" if ie_key and entry.get('id') else f"url:{entry_url}"
+            if video_key in seen:
+                continue
+            seen.add(video_key)
+            yield {"url": entry_url, "video_key": video_key, "title": entry.get('title'), "error": None}
+
+_batch_lock = threading.Lock()
 
+def batch_item_done(batch_id: str, job_id: str) -> None:
+    job = read_job(job_id) or {}
+    publish_event(batch_id, "item", job_id=job_id, status=job.get("status"), error=job.get("error"))
+    close_batch_if_done(batch_id)
+
+def close_batch_if_done(batch_id: str) -> None:
+    # Callbacks for the same batch can finish together; only one of them
+    # may close it. Items still being expanded keep it open.
+    with _batch_lock:
+        batch = read_job(batch_id)
+        if not batch or batch["status"] != "running" or batch.get("stage") != "extract":
+            return
+        counts = batch_counts(batch)
+        if counts.get("queued", 0) + counts.get("running", 0) == 0:
+            update_job(batch_id, status="completed", stage=None,
+                       result={**batch["result"], "counts": counts})
+
+def item_status(job: Optional[Dict]) -> str:
+    # An item whose worker died stays queued or running on disk.
+    return "failed" if not job or is_orphaned(job) else job["status"]
+
+def batch_counts(batch: Dict) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for item in batch["result"]["items"]:
+        status = item_status(read_job(item["job_id"]) if item.get("job_id") else None)
+        counts[status] = counts.get(status, 0) + 1
+    return counts
+
+def start_batch(batch_id: str, request: BatchRequest) -> None:
+    update_job(batch_id, status="running", stage="expand")
+    try:
+        queue_batch(batch_id, request)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        traceback.print_exc()
+        update_job(batch_id, status="failed", stage=None, error={"status_code": 500, "detail": str(e)})
 
-@app.get("/api/download/{temp_dir}/{filename}")
-async def download_chapter(temp_dir: str, filename: str):
-    file_path = os.path.join("temp", temp_dir, filename)
-    if not os.path.exists(file_path):
+def queue_batch(batch_id: str, request: BatchRequest) -> None:
+    # Items are queued as each URL expands, so the first ones run while the
+    # rest of the list is still being expanded. The item list is saved with
+    # every addition; only the hand-off to the pool is in memory.
+    options = request.model_dump(exclude={"urls"})
+    items: List[Dict] = []
+    pending: deque = deque()
+    in_flight = 0
+    lock = threading.Lock()
+
+    def run_next() -> None:
+        nonlocal in_flight
+        with lock:
+            if in_flight >= BATCH_ITEMS_IN_FLIGHT or not pending:
+                return
+            item = pending.popleft()
+            in_flight += 1
+        job_manager.run(run_extraction, item["job_id"], {"url": item["url"], **options},
+                        on_done=item_done, priority="bulk")
+
+    def item_done(job_id: str) -> None:
+        nonlocal in_flight
+        with lock:
+            in_flight -= 1
+        try:
+            batch_item_done(batch_id, job_id)
+        finally:
+            run_next()
+
+    for item in expand_batch_urls(request.urls):
+        if item["error"] is None and len(items) >= BATCH_MAX_ITEMS:
+            item["error"] = f"Batch expands to over {BATCH_MAX_ITEMS} videos"
+        if item["error"] is None:
+            # Items run in the shared job pool as bulk jobs; downloads and
+            # ffmpeg runs inside them take host-wide slots, so one batch
+            # keeps the network and the CPUs busy at once without
+            # oversubscribing either.
+            job = create_job({"url": item["url"], **options}, batch_id=batch_id)
+            item["job_id"] = job["id"]
+        else:
+            item["job_id"] = None
+        items.append(item)
+        publish_event(batch_id, "item", **item, status="queued" if item["job_id"] else "failed")
+        with _batch_lock:
+            update_job(batch_id, result={"items": items})
+        if item["job_id"]:
+            pending.append(item)
+            run_next()
+    with _batch_lock:
+        update_job(batch_id, stage="extract", result={"items": items})
+    # Every item may have finished before expansion did.
+    close_batch_if_done(batch_id)
+
+@app.post("/api/batch", status_code=202)
+async def api_extract_batch(request: BatchRequest):
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="No URLs given")
+    batch = create_job(request.model_dump(), kind="batch")
+    # Expansion is mostly waiting on the network and finishes in the
+    # background; progress is on /api/extract-progress/{batch_id}.
+    asyncio.get_running_loop().run_in_executor(None, start_batch, batch["id"], request)
+    return {
+        "batch_id": batch["id"],
+        "status": batch["status"],
+        "status_url": f"/api/batches/{batch['id']}",
+    }
+
+@app.get("/api/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    batch = read_job(batch_id)
+    if not batch or batch.get("kind") != "batch":
+        raise HTTPException(status_code=404, detail="Batch not found")
+    items = []
+    for item in (batch.get("result") or {}).get("items", []):
+        job = read_job(item["job_id"]) if item["job_id"] else None
+        items.append({
+            "url": item["url"],
+            "title": item["title"],
+            "job_id": item["job_id"],
+            "status": item_status(job),
+            "stage": job.get("stage") if job else None,
+            "error": ((ORPHANED_ERROR if is_orphaned(job) else job.get("error")) if job else None)
+                     or (item["error"] and {"status_code": 400, "detail": item["error"]}),
+            "result": job.get("result") if job else None,
+        })
+    counts: Dict[str, int] = {}
+    for item in items:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    orphaned = is_orphaned(batch)
+    return {
+        "batch_id": batch["id"],
+        "status": "failed" if orphaned else batch["status"],
+        "stage": None if orphaned else batch.get("stage"),
+        "error": ORPHANED_ERROR if orphaned else batch.get("error"),
+        "counts": counts,
+        "items": items,
+    }
+
+_renders: Dict[str, asyncio.Future] = {}
+
+def render_lazy_file(file_path: str, entry: Dict, accurate: bool) -> None:
+    # The lock makes concurrent first requests from other worker processes
+    # wait for one render instead of starting their own.
+    with file_lock(f"{file_path}.lock"):
+        if os.path.exists(file_path):
+            return
+        digest = content_store.link_render(entry['store_key'], file_path)
+        cache_lookup("render", digest is not None)
+        job_id = os.path.basename(os.path.dirname(file_path))
+        if not digest:
+            print(f"Rendering {os.path.basename(file_path)} on demand...")
+            # Charged to the job the file belongs to, after the job itself.
+            with trace_context(job_id):
+                render_chapter_file(entry['source'], entry['output'], entry['kind'], entry['media'], accurate)
+            digest = content_store.put_render(entry['store_key'], file_path)
+        add_file_key(job_id, os.path.basename(file_path), digest)
+
+async def wait_for_manifest(temp_dir: str) -> Optional[Dict]:
+    deadline = time.monotonic() + LAZY_RENDER_TIMEOUT
+    while True:
+        manifest = read_manifest(temp_dir)
+        if manifest is not None:
+            return manifest
+        job = read_job(temp_dir)
+        if not job or job["status"] != "running" or not job.get("result") or time.monotonic() > deadline:
+            return None
+        await asyncio.sleep(0.5)
+
+async def ensure_rendered(temp_dir: str, filename: str, file_path: str) -> bool:
+    manifest = await wait_for_manifest(temp_dir)
+    entry = manifest and manifest['files'].get(filename)
+    if not entry:
+        return False
+
+    # Requests in this process share one render; shield() keeps it running
+    # if the client that started it goes away.
+    render = _renders.get(file_path)
+    if render is None:
+        render = asyncio.ensure_future(asyncio.to_thread(render_lazy_file, file_path, entry, manifest['accurate']))
+        _renders[file_path] = render
+        render.add_done_callback(lambda _: _renders.pop(file_path, None))
+    try:
+        await asyncio.shield(render)
+    except Exception as e:
+        print(f"Error rendering {filename}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to render chapter")
+    return True
+
+@app.get("/api/download/{temp_dir}/bundle.zip")
+async def download_bundle(temp_dir: str, kind: Literal["audio", "video", "all"] = "audio"):
+    job = read_job(temp_dir)
+    if not job or not job.get("result"):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    lease = acquire_lease(job_dir(temp_dir))
+    if lease is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        return await bundle_response(temp_dir, job, kind, lease)
+    except Exception:
+        release_lease(lease)
+        raise
+
+async def bundle_response(temp_dir: str, job: Dict, kind: str, lease: str) -> StreamingResponse:
+    url_keys = {"audio": ["audio_download_url"], "video": ["mp4_download_url"],
+                "all": ["mp4_download_url", "audio_download_url"]}[kind]
+    files = []
+    for chapter in job["result"]["chapters"]:
+        for key in url_keys:
+            if not chapter.get(key):
+                continue
+            filename = os.path.basename(chapter[key])
+            file_path = os.path.join("temp", temp_dir, filename)
+            if not os.path.exists(file_path) and not await ensure_rendered(temp_dir, filename, file_path):
+                raise HTTPException(status_code=409, detail="Chapter files are not ready yet")
+            files.append((filename, file_path))
+    if not files:
+        raise HTTPException(status_code=404, detail="No files to bundle")
+
+    bundle = ZipStream(files)
+    title = job["result"].get("title") or "chapters"
+    clean_title = "".join(c if c.isalnum() else "_" for c in title)
+    return StreamingResponse(
+        bundle,
+        media_type="application/zip",
+        headers={
+            "Content-Length": str(bundle.size),
+            "Content-Disposition": f'attachment; filename="{clean_title}.zip"',
+        },
+        background=BackgroundTask(release_lease, lease),
+    )
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses the weak comparison.
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in header.split(","))
+
+def stat_etag(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return f'W/"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+def file_response(request: Request, file_path: str, media_type: str, filename: str, etag: str,
+                  cache_control: str, background: Optional[BackgroundTask] = None) -> Response:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers, background=background)
+    if SENDFILE_MODE:
+        # The proxy sends the bytes, ranges and all; the worker only decided
+        # that this client may have them.
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+        if SENDFILE_MODE == "x-accel":
+            headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX + quote(os.path.relpath(file_path))
+        else:
+            headers["X-Sendfile"] = os.path.abspath(file_path)
+        return Response(media_type=media_type, headers=headers, background=background)
+    # FileResponse answers single and multi-range requests and If-Range,
+    # checked against the ETag set here.
+    return FileResponse(file_path, media_type=media_type, filename=filename, headers=headers,
+                        background=background)
+
+def chapter_media_type(filename: str) -> str:
+    return CHAPTER_MEDIA_TYPES.get(os.path.splitext(filename)[1], 'video/mp4')
+
+@app.get("/api/objects/{name}")
+async def download_object(name: str, request: Request, filename: Optional[str] = None):
+    key, ext = os.path.splitext(name)
+    if not OBJECT_KEY_PATTERN.fullmatch(key) or ext not in CHAPTER_MEDIA_TYPES:
         raise HTTPException(status_code=404, detail="File not found")
-    media_type = 'audio/mp3' if filename.endswith(".mp3") else 'video/mp4'
-    return FileResponse(file_path, media_type=media_type, filename=filename)
+    path = content_store.get_object(key, ext)
+    if not path:
+        raise HTTPException(status_code=404, detail="File not found")
+    filename = os.path.basename(filename or name)
+    return file_response(request, path, chapter_media_type(name), filename, f'"{key}"', CACHE_IMMUTABLE)
 
+# Declared before the chapter route, which would otherwise match it.
 @app.get("/api/download/thumbnail/{temp_dir}")
-async def download_thumbnail(temp_dir: str):
+async def download_thumbnail(temp_dir: str, request: Request):
+    if not is_job_id(temp_dir):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
     file_path = os.path.join("temp", temp_dir, "thumbnail.jpg")
-    if not os.path.exists(file_path):
+    try:
+        etag = stat_etag(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Thumbnail not found")
-    return FileResponse(file_path, media_type='image/jpeg', filename="thumbnail.jpg")
-
-def clean_temp_folder(temp_root="temp", max_folders=10):
-    if not os.path.exists(temp_root):
-        return
-    folders = [os.path.join(temp_root, d) for d in os.listdir(temp_root) if os.path.isdir(os.path.join(temp_root, d))]
-    folders.sort(key=lambda x: os.path.getctime(x))
-    while len(folders) > max_folders:
-        oldest = folders.pop(0)
-        shutil.rmtree(oldest)
-        print(f"Deleted folder: {oldest}")
+    return file_response(request, file_path, 'image/jpeg', "thumbnail.jpg", etag, CACHE_REVALIDATE)
+
+@app.get("/api/download/{temp_dir}/{filename}")
+async def download_chapter(temp_dir: str, filename: str, request: Request):
+    if not is_job_id(temp_dir):
+        raise HTTPException(status_code=404, detail="File not found")
+    file_path = os.path.join("temp", temp_dir, filename)
+    # The lease keeps the janitor away from the job until the response is sent.
+    lease = acquire_lease(job_dir(temp_dir))
+    try:
+        if not os.path.exists(file_path) and not await ensure_rendered(temp_dir, filename, file_path):
+            raise HTTPException(status_code=404, detail="File not found")
+        key = read_file_keys(temp_dir).get(filename)
+        etag = f'"{key}"' if key else stat_etag(file_path)
+    except Exception:
+        release_lease(lease)
+        raise
+    # Job URLs stop working when the job is evicted, so caches revalidate
+    # them; the ETag makes that a 304.
+    return file_response(request, file_path, chapter_media_type(filename), filename, etag, CACHE_REVALIDATE,
+                         background=BackgroundTask(release_lease, lease) if lease else None)
+
+async def stream_process_output(cmd: List[str], priority: str = "interactive"):
+    # Reading only as fast as the client accepts bytes leaves ffmpeg blocked
+    # on a full pipe, which is the backpressure. A stream slot is held for
+    # the whole response; it is separate from the render slots, so slow
+    # clients cannot starve the renders.
+    stack = ExitStack()
+    # Shielded: a client that goes away while queued must not leave the
+    # thread to take a slot nobody releases.
+    acquire = asyncio.ensure_future(asyncio.to_thread(stack.enter_context, stream_slot()))
+    process = None
+    try:
+        threads = await asyncio.shield(acquire)
+        cmd = niced(budget_command(cmd, threads), FFMPEG_PRIORITIES[priority]['nice'])
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+        while True:
+            chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        if await process.wait():
+            FFMPEG_FAILURES.labels("serve").inc()
+            print(f"Error streaming chapter: ffmpeg exited with {process.returncode}")
+    finally:
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+        if acquire.done():
+            stack.close()
+        else:
+            acquire.add_done_callback(lambda _: stack.close())
+
+@app.get("/api/stream/{temp_dir}/{filename}")
+async def stream_chapter(temp_dir: str, filename: str):
+    manifest = await wait_for_manifest(temp_dir)
+    entry = manifest and manifest['files'].get(filename)
+    if not entry:
+        raise HTTPException(status_code=404, detail="File not found")
+    cmd = build_stream_command(entry['source'], entry['output'], entry['kind'], entry['media'])
+    lease = acquire_lease(job_dir(temp_dir))
+    if lease is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return StreamingResponse(
+        stream_process_output(cmd),
+        media_type=chapter_media_type(filename),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        background=BackgroundTask(release_lease, lease),
+    )
+
+@app.get("/api/janitor")
+async def janitor_stats():
+    return janitor.stats()
+
+@app.get("/api/upstream")
+async def upstream_state():
+    return await asyncio.to_thread(upstream.state)
+
+@app.get("/metrics")
+async def metrics():
+    # Aggregated over every worker process on this host.
+    body = await asyncio.to_thread(render_metrics, count_jobs, upstream.state)
+    return Response(body, media_type=CONTENT_TYPE_LATEST)
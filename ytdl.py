@@ -0,0 +1,109 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# Idle YoutubeDL instances kept per option set. Building one registers the
+# extractors and parses the cookie file; a reused one also keeps its
+# extractors' caches (player JS, API tokens) between requests.
+YTDL_POOL_SIZE = int(os.environ.get("YTDL_POOL_SIZE", "4"))
+
+_import_lock = threading.Lock()
+
+
+def import_yt_dlp():
+    # yt_dlp takes a few hundred milliseconds to import, so it is deferred
+    # out of worker boot. Its modules import each other circularly, and a
+    # second thread importing it meanwhile can get a partially initialised
+    # module, so every import goes through this lock.
+    with _import_lock:
+        import yt_dlp
+    return yt_dlp
+
+
+class _PooledYoutubeDL:
+    def __init__(self, options: Dict):
+        yt_dlp = import_yt_dlp()
+        self.ydl = yt_dlp.YoutubeDL(dict(options))
+        self.outtmpl = dict(self.ydl.params['outtmpl'])
+        self.progress_hook: Optional[Callable[[Dict], None]] = None
+        # Installed once; the hook of the current checkout is swapped in.
+        self.ydl.add_progress_hook(self._dispatch)
+
+    def _dispatch(self, d: Dict) -> None:
+        if self.progress_hook is not None:
+            self.progress_hook(d)
+
+    def checkout(self, outtmpl: Optional[str], download_ranges: Optional[Callable],
+                 progress_hook: Optional[Callable[[Dict], None]]) -> None:
+        if outtmpl is not None:
+            self.ydl.params['outtmpl'] = {**self.outtmpl, 'default': outtmpl}
+        if download_ranges is not None:
+            self.ydl.params['download_ranges'] = download_ranges
+        self.progress_hook = progress_hook
+
+    def reset(self) -> None:
+        self.ydl.params['outtmpl'] = dict(self.outtmpl)
+        self.ydl.params.pop('download_ranges', None)
+        self.progress_hook = None
+
+
+class YoutubeDLPool:
+    """Hands out YoutubeDL instances, one caller at a time each, reused
+    across requests that share an option set.
+
+    Per-call settings (output template, download ranges, progress hook) are
+    applied on checkout and undone on return, so they are not part of the
+    option set. An instance that raised is closed rather than reused.
+    """
+
+    def __init__(self, size: int = YTDL_POOL_SIZE):
+        self.size = size
+        self._idle: Dict[str, List[_PooledYoutubeDL]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(options: Dict) -> str:
+        return json.dumps(options, sort_keys=True, default=repr)
+
+    def _take(self, key: str) -> Optional[_PooledYoutubeDL]:
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def _give_back(self, key: str, entry: _PooledYoutubeDL) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(entry)
+                return
+        entry.ydl.close()
+
+    @contextmanager
+    def get(self, options: Dict, outtmpl: Optional[str] = None, download_ranges: Optional[Callable] = None,
+            progress_hook: Optional[Callable[[Dict], None]] = None):
+        key = self._key(options)
+        entry = self._take(key) or _PooledYoutubeDL(options)
+        entry.checkout(outtmpl, download_ranges, progress_hook)
+        try:
+            yield entry.ydl
+        except BaseException:
+            entry.ydl.close()
+            raise
+        entry.reset()
+        self._give_back(key, entry)
+
+    def warm(self, options: Dict) -> None:
+        key = self._key(options)
+        with self._lock:
+            if self._idle.get(key):
+                return
+        self._give_back(key, _PooledYoutubeDL(options))
+
+    def close(self) -> None:
+        with self._lock:
+            entries = [entry for idle in self._idle.values() for entry in idle]
+            self._idle.clear()
+        for entry in entries:
+            entry.ydl.close()
@@ -0,0 +1,124 @@
+import os
+import time
+import zlib
+import struct
+from typing import Iterator, List, Tuple
+
+# Store-only ZIP writer for streaming responses. Entry sizes are taken from
+# the filesystem up front, so the archive length is exact before the first
+# byte is sent; CRCs are computed while the data streams and written in data
+# descriptors and the central directory at the end. ZIP64 records are used
+# only where a size or offset needs them.
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP16_LIMIT = 0xFFFF
+CHUNK_SIZE = 1024 * 1024
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStream:
+    def __init__(self, files: List[Tuple[str, str]]):
+        # files: (archive name, path on disk)
+        self.entries = []
+        offset = 0
+        for arcname, path in files:
+            stat = os.stat(path)
+            name = arcname.encode("utf-8")
+            zip64 = stat.st_size >= ZIP32_LIMIT
+            entry = {
+                "name": name,
+                "path": path,
+                "size": stat.st_size,
+                "datetime": _dos_datetime(stat.st_mtime),
+                "zip64": zip64,
+                "offset": offset,
+                "crc": 0,
+            }
+            offset += len(self._local_header(entry)) + entry["size"] + (24 if zip64 else 16)
+            self.entries.append(entry)
+        self.central_offset = offset
+        self.central_size = sum(len(self._central_header(entry)) for entry in self.entries)
+        self.size = offset + self.central_size + len(self._end_records())
+
+    def _local_header(self, entry: dict) -> bytes:
+        extra = b""
+        size = entry["size"]
+        if entry["zip64"]:
+            extra = struct.pack("<HHQQ", 0x0001, 16, size, size)
+            size = ZIP32_LIMIT
+        dos_time, dos_date = entry["datetime"]
+        # With a data descriptor the CRC field stays zero here; the sizes
+        # are known, so they are filled in for readers that want them.
+        return struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50, 45 if entry["zip64"] else 20, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, 0,
+            dos_time, dos_date, 0, size, size, len(entry["name"]), len(extra),
+        ) + entry["name"] + extra
+
+    def _data_descriptor(self, entry: dict) -> bytes:
+        if entry["zip64"]:
+            return struct.pack("<IIQQ", 0x08074B50, entry["crc"], entry["size"], entry["size"])
+        return struct.pack("<IIII", 0x08074B50, entry["crc"], entry["size"], entry["size"])
+
+    def _central_header(self, entry: dict) -> bytes:
+        size, offset = entry["size"], entry["offset"]
+        extra_fields = b""
+        if entry["zip64"]:
+            extra_fields += struct.pack("<QQ", size, size)
+            size = ZIP32_LIMIT
+        if offset >= ZIP32_LIMIT:
+            extra_fields += struct.pack("<Q", offset)
+            offset = ZIP32_LIMIT
+        extra = struct.pack("<HH", 0x0001, len(extra_fields)) + extra_fields if extra_fields else b""
+        needs_zip64 = bool(extra_fields)
+        dos_time, dos_date = entry["datetime"]
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50, 45 if needs_zip64 else 20, 45 if needs_zip64 else 20,
+            FLAG_DATA_DESCRIPTOR | FLAG_UTF8, 0, dos_time, dos_date,
+            entry["crc"], size, size, len(entry["name"]), len(extra), 0, 0, 0, 0, offset,
+        ) + entry["name"] + extra
+
+    def _end_records(self) -> bytes:
+        count = len(self.entries)
+        records = b""
+        if count >= ZIP16_LIMIT or self.central_size >= ZIP32_LIMIT or self.central_offset >= ZIP32_LIMIT:
+            zip64_end_offset = self.central_offset + self.central_size
+            records += struct.pack(
+                "<IQHHIIQQQQ",
+                0x06064B50, 44, 45, 45, 0, 0, count, count, self.central_size, self.central_offset,
+            )
+            records += struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+        records += struct.pack(
+            "<IHHHHIIH",
+            0x06054B50, 0, 0, min(count, ZIP16_LIMIT), min(count, ZIP16_LIMIT),
+            min(self.central_size, ZIP32_LIMIT), min(self.central_offset, ZIP32_LIMIT), 0,
+        )
+        return records
+
+    def __iter__(self) -> Iterator[bytes]:
+        for entry in self.entries:
+            yield self._local_header(entry)
+            crc = 0
+            with open(entry["path"], "rb") as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+            entry["crc"] = crc
+            yield self._data_descriptor(entry)
+        for entry in self.entries:
+            yield self._central_header(entry)
+        yield self._end_records()